@@ -4,10 +4,11 @@
 
 from datetime import date
 import matplotlib.pyplot as plt
-import numpy as np
 import os
 import pandas as pd
 
+from DataScripts.read_files import prep_object_vectors
+
 
 # Parameters
 images_file = os.path.join(
@@ -27,15 +28,7 @@ except FileNotFoundError:
     raise Exception('[ERROR] images.txt file not found.')
 
 # Read detections file
-try:
-    with open(os.path.join(segment_vectors_dir, 'detections.csv'), 'r') as file:
-        object_vectors = pd.read_csv(
-            file, dtype={'segment_id': object, 'img_id': object,
-                         'object_id': object, 'confidence': float,
-                         'bbox_size': float, 'class': object},
-            na_values=['None'])
-except FileNotFoundError:
-    raise Exception('[ERROR] Segment vectors file not found.')
+object_vectors = prep_object_vectors(segment_vectors_dir)
 
 # Filter for saved images
 image_log = image_log[image_log['img_id'] != 'NotSaved']
@@ -51,7 +44,7 @@ plt.show()
 # Check correlation between image dates and number of objects counted
 # * Get image date
 object_counts = object_vectors[['segment_id', 'img_id', 'object_id']].\
-    groupby(['segment_id', 'img_id']).count().reset_index()
+    groupby(['segment_id', 'img_id'], observed=True).count().reset_index()
 object_counts.rename(columns={'object_id': 'num_objects'}, inplace=True)
 
 object_counts['full_img_id'] = object_counts.apply(
@@ -63,8 +56,7 @@ object_counts_dates = image_log.merge(
     validate='many_to_one')
 
 # Assign zero to NA cases as there were no detections for these images
-object_counts_dates['num_objects'] = object_counts_dates['num_objects'].apply(
-    lambda x: 0 if np.isnan(x) else x)
+object_counts_dates['num_objects'] = object_counts_dates['num_objects'].fillna(0)
 
 # Convert date to float
 min_date = object_counts_dates['img_date'].min()
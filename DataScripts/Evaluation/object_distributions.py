@@ -5,6 +5,7 @@ from datetime import date
 import folium
 import geopandas as gpd
 import matplotlib.pyplot as plt
+import numpy as np
 import os
 import osmnx as ox
 import pandas as pd
@@ -13,7 +14,7 @@ from shapely.geometry import Point
 from DataScripts.locations import LOCATIONS
 from DataScripts.object_classes import CLASSES_TO_LABEL
 from DataScripts.read_files import prep_object_vectors_with_dates
-from DataScripts.urbanchange_utils import generate_location_graph
+from DataScripts.urbanchange_utils import load_location_graph
 
 
 # Parameters
@@ -72,12 +73,10 @@ object_locations = object_locations[
     (object_locations['pano_lat'].notnull()) & (object_locations['pano_lng'].notnull())]
 
 # Set up dates
-object_locations['img_date'] = pd.to_datetime(object_locations['img_date'])
-object_locations['img_date'] = object_locations['img_date'].apply(
-    lambda x: x.date())
-
-urban_index['segment_date'] = pd.to_datetime(urban_index['segment_date'])
-urban_index['segment_date'] = urban_index['segment_date'].apply(lambda x: x.date())
+object_locations['img_date'] = pd.to_datetime(
+    object_locations['img_date']).dt.normalize()
+urban_index['segment_date'] = pd.to_datetime(
+    urban_index['segment_date']).dt.normalize()
 
 # Set up GeoDataFrame
 object_locations['geometry'] = object_locations.apply(
@@ -111,14 +110,14 @@ neighborhood_map.save(os.path.join(output_path, 'obj_distributions.html'))
 
 # Static maps ---------------------------------------------
 if TIMESTAMPED_NEIGHBORHOOD:
-    gdf['year'] = gdf['img_date'].apply(lambda x: x.year)
+    gdf['year'] = gdf['img_date'].dt.year
     YEARS = range(gdf['year'].min(), gdf['year'].max() + 1)
 else:
     gdf['year'] = 'fixed'
     YEARS = ['fixed']
 
 neighborhood = LOCATIONS[SELECTED_NEIGHBORHOOD]
-G = generate_location_graph(neighborhood=neighborhood, simplify=True)
+G = load_location_graph(neighborhood=neighborhood, simplify=True)
 _, edges = ox.graph_to_gdfs(G)
 
 edges = edges[['geometry']].copy()
@@ -126,16 +125,11 @@ edges.reset_index(inplace=True)
 edges = edges.drop_duplicates(subset=['u', 'v'])
 gdf_edges = gpd.GeoDataFrame(edges, geometry='geometry')
 
-# Color edges according to imagery availability
-urban_index['year'] = urban_index['segment_date'].apply(lambda x: x.year)
-
-
-def check_nodes(u, v, seg_set):
-    if '{}-{}'.format(u, v) in seg_set or '{}-{}'.format(v, u) in seg_set:
-        return 'black'
-    else:
-        return 'lightgray'
-
+# Color edges according to imagery availability. Segment IDs may list the
+# edge nodes in either order.
+urban_index['year'] = urban_index['segment_date'].dt.year
+edge_ids = gdf_edges['u'].astype(str) + '-' + gdf_edges['v'].astype(str)
+reverse_edge_ids = gdf_edges['v'].astype(str) + '-' + gdf_edges['u'].astype(str)
 
 # Generate plots for every year and class combination
 for year in YEARS:
@@ -143,8 +137,9 @@ for year in YEARS:
     annual_segments = set(
         urban_index[(urban_index['year'] == year) &
                     (urban_index['facade'].notnull())]['segment_id'].to_list())
-    gdf_edges['color'] = gdf_edges.apply(
-        lambda row: check_nodes(row['u'], row['v'], annual_segments), axis=1)
+    gdf_edges['color'] = np.where(
+        edge_ids.isin(annual_segments) | reverse_edge_ids.isin(annual_segments),
+        'black', 'lightgray')
 
     for obj_class in list(CLASSES_TO_LABEL.keys()):
         current_gdf = gdf[(gdf['class'] == obj_class) & (gdf['year'] == year)].copy()
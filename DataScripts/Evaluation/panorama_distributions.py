@@ -71,10 +71,10 @@ neighborhood_map.save(os.path.join(output_path))
 
 # Relationship between available panoramas and object counts
 available_panoramas = image_log[['segment_id', 'img_id']].\
-    groupby('segment_id').count().reset_index()
+    groupby('segment_id', observed=True).count().reset_index()
 
 num_objects = object_vectors[['segment_id', 'object_id']].\
-    groupby('segment_id').count().reset_index()
+    groupby('segment_id', observed=True).count().reset_index()
 
 counts = available_panoramas.merge(
     num_objects, how='left', on='segment_id', validate='one_to_one')
@@ -85,15 +85,15 @@ plt.ylabel('Number of objects counted per street segment')
 plt.show()
 
 # Relationship between number of panoramas and street segment length
-segment_df = pd.DataFrame({'segment_id': [], 'length': []})
+segment_rows = []
 for key, value in segment_dictionary.items():
     # Hash segment ID
     segment_id = json.loads(value['segment_id'])
     segment_id = '{}-{}'.format(segment_id[0], segment_id[1])
 
-    segment_df = segment_df.append(
-        {'segment_id': segment_id, 'length': value['length']},
-        ignore_index=True)
+    segment_rows.append(
+        {'segment_id': segment_id, 'length': value['length']})
+segment_df = pd.DataFrame(segment_rows, columns=['segment_id', 'length'])
 
 counts = counts.merge(segment_df, on='segment_id', validate='one_to_one')
 
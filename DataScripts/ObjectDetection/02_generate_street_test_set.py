@@ -2,7 +2,8 @@ import numpy as np
 import os
 
 import DataScripts.CONFIG as CONFIG
-from DataScripts.urbanchange_utils import save_SV_image, reverse_geocode
+from DataScripts.urbanchange_utils import save_SV_images, reverse_geocode
+from DataScripts.urbanchange_utils import save_geocode_cache
 
 
 # Test set parameters
@@ -12,6 +13,8 @@ OUTPUT_DIR = os.path.join('..', '..', 'Data', 'RawData',
 # Define the grid cell from which we will sample our locations
 GRID = [[37.76583204171835, -122.43090178068529],  # Mission District
         [37.74947816540197, -122.40373636829808]]
+# Reverse geocoding responses are cached here across runs
+GEOCODE_CACHE = os.path.join(OUTPUT_DIR, 'reverse_geocode_cache.pkl')
 
 # Set up a parameter dictionary for each image and reverse geocode request
 img_params = {
@@ -41,30 +44,39 @@ if __name__ == '__main__':
 
     # Save test images
     test_counter = 0
+    test_images, test_image_files = [], []
     print('[INFO] Saving images for each location...')
-    for i, (lat, lng) in enumerate(zip(lats, lngs)):
-        # Geocode location to addresses if available
-        geo_params['latlng'] = '{},{}'.format(lat, lng)
-        geo_request = reverse_geocode(params=geo_params)
-        if geo_request['status'] != 'OK':
-            continue
-        elif len(geo_request['results']) == 0:
-            continue
-        else:
-            address = geo_request['results'][0]['formatted_address']
+    try:
+        for i, (lat, lng) in enumerate(zip(lats, lngs)):
+            # Geocode location to addresses if available
+            geo_params['latlng'] = '{},{}'.format(lat, lng)
+            geo_request = reverse_geocode(params=geo_params, cache_file=GEOCODE_CACHE)
+            if geo_request['status'] != 'OK':
+                continue
+            elif len(geo_request['results']) == 0:
+                continue
+            else:
+                address = geo_request['results'][0]['formatted_address']
 
-        # Verify that the address is within the neighborhood
-        address_lat = geo_request['results'][0]['geometry']['location']['lat']
-        address_lng = geo_request['results'][0]['geometry']['location']['lng']
-        lat_OK = abs(GRID[0][0]) >= abs(address_lat) >= abs(GRID[1][0])
-        lng_OK = abs(GRID[0][1]) >= abs(address_lng) >= abs(GRID[1][1])
-        if not lat_OK and lng_OK:
-            continue
+            # Verify that the address is within the neighborhood
+            address_lat = geo_request['results'][0]['geometry']['location']['lat']
+            address_lng = geo_request['results'][0]['geometry']['location']['lng']
+            lat_OK = abs(GRID[0][0]) >= abs(address_lat) >= abs(GRID[1][0])
+            lng_OK = abs(GRID[0][1]) >= abs(address_lng) >= abs(GRID[1][1])
+            if not lat_OK and lng_OK:
+                continue
 
-        # Get image of the location
-        img_params['location'] = address
-        save_SV_image(params=img_params, output_dir=OUTPUT_DIR,
-                      file_name='test_{}'.format(str(test_counter).zfill(3)))
-        test_counter += 1
+            # Get image of the location
+            img_params['location'] = address
+            test_images.append(img_params.copy())
+            test_image_files.append(os.path.join(
+                OUTPUT_DIR, 'test_{}.png'.format(str(test_counter).zfill(3))))
+            test_counter += 1
+    finally:
+        # Keep the responses received so far, also if the run is interrupted
+        save_geocode_cache(GEOCODE_CACHE)
+
+    # Download the test images concurrently
+    save_SV_images(test_images, test_image_files)
 
 print('[INFO] {} Test images generated.'.format(test_counter))
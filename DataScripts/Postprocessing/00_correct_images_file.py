@@ -49,22 +49,21 @@ if __name__ == '__main__':
         # Find the lines with multiple image logs
         with open(os.path.join(images_dir, 'images_raw.txt'), 'r') as file:
             image_log = file.readlines()
-        new_image_log = Logger(os.path.join(images_dir, 'images.txt'))
+        with Logger(os.path.join(images_dir, 'images.txt')) as new_image_log:
+            for i, log in enumerate(tqdm(image_log)):
+                if len(log.split(' ')) == num_columns_image_log:
+                    new_image_log.write(log.rstrip())
+                elif len(log.split(' ')) <= num_columns_image_log:
+                    raise Exception('[ERROR] Too few columns in row {}: {}.'.format(
+                        i, len(log.split(' '))))
+                else:
+                    print('[INFO] Fixing line {}'.format(i))
 
-        for i, log in enumerate(tqdm(image_log)):
-            if len(log.split(' ')) == num_columns_image_log:
-                new_image_log.write(log.rstrip())
-            elif len(log.split(' ')) <= num_columns_image_log:
-                raise Exception('[ERROR] Too few columns in row {}: {}.'.format(
-                    i, len(log.split(' '))))
-            else:
-                print('[INFO] Fixing line {}'.format(i))
-
-                # Split the row with two image logs
-                comps = log.split('END')
-                log1 = comps[0] + 'END'
-                log2 = comps[1] + 'END'
-                new_image_log.write(log1)
-                new_image_log.write(log2)
+                    # Split the row with two image logs
+                    comps = log.split('END')
+                    log1 = comps[0] + 'END'
+                    log2 = comps[1] + 'END'
+                    new_image_log.write(log1)
+                    new_image_log.write(log2)
 
     print('[INFO] images.txt file ready to be used in Postprocessing pipeline.')
@@ -13,11 +13,11 @@
 #   - Directory containing the location's images (from 02_collect_street_segment_images.py)
 #
 # Outputs:
-#   - CSV file including one row per detected object instance, saved to the
-#     selected output_path
+#   - Parquet file (detections.parquet) including one row per detected object
+#     instance, saved to the selected output_path
 
 import argparse
-import glob
+from collections import defaultdict
 import json
 import numpy as np
 import os
@@ -41,46 +41,111 @@ parser.add_argument('-o', '--output_path', required=True,
                     help='Output path for segment vectors')
 parser.add_argument('-i', '--input_images', required=True,
                     help='Path to input images for inference')
+parser.add_argument('-b', '--batch_size', default=32, type=int,
+                    help='Minimum number of images per inference batch')
 
 
-def get_objects(img_result, model_names_list, image_path, seg_id, torch_device):
+def get_objects(img_result, model_names_list, image_id, seg_id, torch_device):
     """
     Returns a dictionary including the bbox size, confidence and class of each
     object instance detected in an image.
     :param img_result: (tensor) of size (number of objects detected, 6),
     where the columns represent: x1, y1, x2, x2, confidence, class
-    :param model_names_list: (list) of classes being predicted (in the order
+    :param model_names_list: (np.array) of classes being predicted (in the order
     they are being encoded)
     :param seg_id: (str)
-    :param image_path: (str)
+    :param image_id: (str) image name without the img_{seg_id}_ prefix and
+    file extension
     :param torch_device: one of ['cuda', 'cpu']
-    :return: (dict) including the count for each of the classes in model_names_list
+    :return: (dict) of np.arrays with one value for each object instance
     """
     object_dict = {}
     num_objects = img_result.shape[0]
 
+    # Results of the half precision model are upcast so bbox areas don't
+    # overflow float16
     if torch_device == 'cuda':
-        img_result = img_result.cpu()
+        img_result = img_result.float().cpu()
     img_result = img_result.numpy()
 
     # Add image and segment ID
-    object_dict['segment_id'] = [seg_id] * num_objects
-    image_id = image_path.split(os.path.sep)[-1]. \
-        split('img_{}_'.format(seg_id))[-1].split('.png')[0]
-    object_dict['img_id'] = [image_id] * num_objects
+    object_dict['segment_id'] = np.full(num_objects, seg_id)
+    object_dict['img_id'] = np.full(num_objects, image_id)
 
     # Get objects
-    object_dict['confidence'] = img_result[:, 4].tolist()
+    object_dict['confidence'] = img_result[:, 4]
     object_dict['bbox_size'] = np.multiply(
-        img_result[:, 2] - img_result[:, 0], img_result[:, 3] - img_result[:, 1]).tolist()
+        img_result[:, 2] - img_result[:, 0], img_result[:, 3] - img_result[:, 1])
 
     # Get object classes
-    obj_classes = img_result[:, 5].tolist()
-    object_dict['class'] = [model_names_list[int(c_id)] for c_id in obj_classes]
+    object_dict['class'] = model_names_list[img_result[:, 5].astype(np.intp)]
 
     return object_dict
 
 
+def detect_segment_batch(model, segments, image_paths, image_ids, image_size,
+                         model_names_list, torch_device, logger):
+    """
+    Runs inference on the images of a batch of street segments at once and
+    writes each detected object instance to the logger, segment by segment.
+    :param model: YOLOv5 model
+    :param segments: (list of tuples) (segment_id, number of images) for each
+    segment in the batch
+    :param image_paths: (list of str) images of the segments, in segment order
+    :param image_ids: (list of str) image IDs matching image_paths
+    :param image_size: (int)
+    :param model_names_list: (np.array) of classes being predicted
+    :param torch_device: one of ['cuda', 'cpu']
+    :param logger: (AppendLogger)
+    :return: void
+    """
+    image_results = []
+    if len(image_paths) > 0:
+        try:
+            image_results = model(image_paths, size=image_size).xyxy
+        except RuntimeError:
+            # Handle out of memory errors
+            for image_path_group in np.array_split(image_paths, 4):
+                if len(image_path_group) > 0:
+                    image_results.extend(model(
+                        image_path_group.tolist(), size=image_size).xyxy)
+
+    image_start = 0
+    for segment_id, num_images in segments:
+        segment_result_counter = 0
+        for img_result, image_id in zip(
+                image_results[image_start:image_start + num_images],
+                image_ids[image_start:image_start + num_images]):
+            # Get objects
+            img_objects = get_objects(
+                img_result, model_names_list, image_id, segment_id,
+                torch_device)
+
+            # Loop over each object instance in the image and write to logger
+            for j, (confidence, bbox_size, object_class) in enumerate(zip(
+                    img_objects['confidence'].tolist(),
+                    img_objects['bbox_size'].tolist(),
+                    img_objects['class'].tolist())):
+                logger.write('{} {} {} {} {} {}'.format(
+                    img_objects['segment_id'][j],  # Segment ID
+                    img_objects['img_id'][j],  # Image ID
+                    j,  # Object instance ID
+                    round(confidence, 4),  # Confidence
+                    round(bbox_size, 2),  # Bounding box size
+                    object_class  # Class
+                ))
+                segment_result_counter += 1
+        image_start += num_images
+
+        # Identify segments without images or detected objects by adding a row
+        # of Nones. A segment will usually have no associated images if it had
+        # an unavailable heading for it's first node or if it had no
+        # associated coordinates.
+        if segment_result_counter == 0:
+            logger.write('{} {} {} {} {} {}'.format(
+                segment_id, None, None, None, None, None))
+
+
 if __name__ == '__main__':
     # Capture command line arguments
     args = vars(parser.parse_args())
@@ -89,27 +154,43 @@ if __name__ == '__main__':
     segment_dictionary_file = args['segment_dictionary']
     output_path = args['output_path']
     input_images = args['input_images']
+    batch_size = args['batch_size']
 
     # Load segment dictionary
     segment_dictionary = load_segment_dict(segment_dictionary_file)
 
-    # Check images directory
-    num_images = len(glob.glob(os.path.join(input_images, '*.png')))
-    if num_images == 0:
+    # Check images directory and group the images by segment, parsing the
+    # image IDs once.
+    # Note: images are named img_{segment_id}_h{heading}_{location}.png
+    image_names = [name for name in os.listdir(input_images)
+                   if name.endswith('.png') and not name.startswith('.')]
+    if len(image_names) == 0:
         raise Exception('[ERROR] No images found in images directory.')
 
-    # Load model with custom weights
+    segment_images = defaultdict(list)
+    for image_name in image_names:
+        if image_name.startswith('img_'):
+            image_segment_id, separator, image_id = \
+                os.path.splitext(image_name)[0][4:].partition('_')
+            if separator:
+                segment_images[image_segment_id].append(
+                    (os.path.join(input_images, image_name), image_id))
+
+    # Identify device
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+
+    # Load model with custom weights. On GPU the model is run in half precision.
     print('[INFO] Loading YOLOv5 model with custom weights.')
     model = torch.hub.load('ultralytics/yolov5', 'custom', path=model_weights)
-    model_names = model.names
+    model = model.to(device).eval()
+    if device == 'cuda':
+        model = model.half()
+    model_names = np.asarray([model.names[i] for i in range(len(model.names))])
 
     # Set up intermediate txt file
     logger_path = os.path.join(output_path, 'detections_temp.txt')
     logger = AppendLogger(logger_path)
 
-    # Identify device
-    device = 'cuda' if torch.cuda.is_available() else 'cpu'
-
     # Verify image neighborhood matches segment dictionary neighborhood
     segment_neighborhood = \
         segment_dictionary_file.split(os.path.sep)[-1].split('.')[0].split('_')[-1]
@@ -130,71 +211,35 @@ if __name__ == '__main__':
             segment.split(' ')[0] for segment in processed_segments]
         key_start = len(set(processed_segments)) - 1
 
-    # Inference on each segment and image
+    # Inference on batches of segments. Segments are queued until their images
+    # fill a batch and are then written to the logger in order.
     print('[INFO] Generating {} segment vectors for {}'.format(
         len(segment_dictionary) - key_start, segment_neighborhood))
-    for key in tqdm(range(key_start, len(segment_dictionary))):
-        segment = segment_dictionary[str(key)]
-
-        # Hash segment ID
-        segment_id = json.loads(segment['segment_id'])
-        segment_id = '{}-{}'.format(segment_id[0], segment_id[1])
-
-        # Get segment images
-        images = glob.glob(
-            os.path.join(input_images, 'img_{}_*.png'.format(segment_id)))
-        image_paths = images.copy()
-
-        # Skip the segment if it has no associated images (identify missing
-        # by adding a row of Nones). A segment will usually have no associated
-        # images if it had an unavailable heading for it's first node or if
-        # it had no associated coordinates.
-        if len(image_paths) == 0:
-            logger.write('{} {} {} {} {} {}'.format(
-                segment_id, None, None, None, None, None))
-            continue
-
-        results_list, image_paths_list = [], []
-        try:
-            results = model(images, size=image_size)
-            results_list.append(results)
-            image_paths_list.append(image_paths)
-        except RuntimeError:
-            # Handle out of memory errors
-            image_path_groups = np.array_split(image_paths, 4)
-            for image_path_group in image_path_groups:
-                image_path_group = image_path_group.tolist()
-                images_group = image_path_group.copy()
-                results_group = model(images_group, size=image_size)
-                results_list.append(results_group)
-                image_paths_list.append(image_path_group)
-
-        # Add to segment vector DataFrame
-        # Loop over each image in the segment
-        segment_result_counter = 0
-        for results_batch, image_paths_batch in zip(results_list, image_paths_list):
-            # Loop over each image
-            for i in range(len(results_batch)):
-                # Get objects and image ID
-                img_objects = get_objects(
-                    results_batch.xyxy[i], model_names, image_paths_batch[i],
-                    segment_id, device)
-
-                # Loop over each object instance in the image and write to logger
-                for j in range(len(img_objects['segment_id'])):
-                    logger.write('{} {} {} {} {} {}'.format(
-                        img_objects['segment_id'][j],  # Segment ID
-                        img_objects['img_id'][j],  # Image ID
-                        j,  # Object instance ID
-                        round(img_objects['confidence'][j], 4),  # Confidence
-                        round(img_objects['bbox_size'][j], 2),  # Bounding box size
-                        img_objects['class'][j]  # Class
-                    ))
-                    segment_result_counter += 1
-
-        if segment_result_counter == 0:
-            logger.write('{} {} {} {} {} {}'.format(
-                segment_id, None, None, None, None, None))
+    batch_segments, batch_image_paths, batch_image_ids = [], [], []
+    try:
+        for key in tqdm(range(key_start, len(segment_dictionary))):
+            segment = segment_dictionary[str(key)]
+
+            # Hash segment ID
+            segment_id = json.loads(segment['segment_id'])
+            segment_id = '{}-{}'.format(segment_id[0], segment_id[1])
+
+            # Get segment images
+            images = segment_images.get(segment_id, [])
+            batch_segments.append((segment_id, len(images)))
+            batch_image_paths.extend(image_path for image_path, _ in images)
+            batch_image_ids.extend(image_id for _, image_id in images)
+
+            if len(batch_image_paths) >= batch_size or \
+                    key == len(segment_dictionary) - 1:
+                with torch.inference_mode():
+                    detect_segment_batch(
+                        model, batch_segments, batch_image_paths, batch_image_ids,
+                        image_size, model_names, device, logger)
+                logger.flush()
+                batch_segments, batch_image_paths, batch_image_ids = [], [], []
+    finally:
+        logger.close()
 
     # Check number of processed object vectors and save to DataFrame
     with open(logger_path, 'r') as file:
@@ -205,25 +250,23 @@ if __name__ == '__main__':
 
     # Export to pd.DataFrame if all segments have been processed
     if number_of_processed_segments == len(segment_dictionary):
-        df_columns = {'segment_id': [], 'img_id': [], 'object_id': [],
-                      'confidence': [], 'bbox_size': [], 'class': []}
-        object_vectors = pd.DataFrame(df_columns)
-
-        # Loop over the object instances
-        for object_instance in tqdm(processed_object_vectors):
-            segment_id, img_id, object_id, confidence, bbox_size, class_id = \
-                object_instance.rstrip().split(' ')
-            object_instance_dict = {'segment_id': segment_id,
-                                    'img_id': img_id,
-                                    'object_id': object_id,
-                                    'confidence': confidence,
-                                    'bbox_size': bbox_size,
-                                    'class': class_id}
-            object_vectors = object_vectors.append(
-                object_instance_dict, ignore_index=True)
-
-        # Export to CSV
-        object_vectors.to_csv(
-            os.path.join(output_path, 'detections.csv'), index=False)
+        # Split the object instances and build the DataFrame once
+        object_instances = [
+            object_instance.rstrip().split(' ')
+            for object_instance in tqdm(processed_object_vectors)]
+        object_vectors = pd.DataFrame(
+            object_instances, columns=['segment_id', 'img_id', 'object_id',
+                                       'confidence', 'bbox_size', 'class'])
+
+        # Type the columns (segments without objects are logged as None) and
+        # export to Parquet. Identifier and class columns are stored
+        # dictionary-encoded.
+        object_vectors = object_vectors.mask(object_vectors == 'None')
+        object_vectors = object_vectors.astype({
+            'segment_id': 'category', 'img_id': 'category',
+            'confidence': float, 'bbox_size': float, 'class': 'category'})
+        object_vectors.to_parquet(
+            os.path.join(output_path, 'detections.parquet'), engine='pyarrow',
+            compression='zstd', index=False)
     else:
         raise Exception('[ERROR] Incomplete street segment temporary file.')
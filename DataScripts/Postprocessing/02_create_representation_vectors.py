@@ -9,6 +9,10 @@
 #   -i Data/ProcessedData/SFStreetView/Res_640/MissionDistrictBlock_2011-02-01_3/
 #   -m mark_missing
 #   -c 50
+#   [-j 4]
+# Segments are aggregated in a single process by default. Pass -j (or set the
+# N_JOBS environment variable) to use several cores, keeping in mind the other
+# jobs sharing the machine.
 #
 # Data inputs:
 #   - CSV file including one row per detected object instance (generated
@@ -25,18 +29,21 @@
 import argparse
 from datetime import date
 import json
+from joblib import delayed, Parallel
 import numpy as np
 import os
 import pandas as pd
 from tqdm import tqdm
 
 from DataScripts.object_classes import CLASSES_TO_LABEL
+from DataScripts.read_files import get_image_names
 from DataScripts.read_files import prep_image_log, prep_object_vectors
 from DataScripts.read_files import load_segment_dict
 from DataScripts.urbanchange_utils import AppendLogger
 
 from DataScripts.vector_aggregations import MISSING_IMAGE_NORMALIZATION
-from DataScripts.vector_aggregations import AGGREGATIONS
+from DataScripts.vector_aggregations import AGGREGATIONS, aggregate_all
+from DataScripts.vector_aggregations import CLASS_NAMES
 from DataScripts.vector_aggregations import MIN_NUMBER_OF_PANORAMAS
 
 # Set up command line arguments
@@ -56,6 +63,109 @@ parser.add_argument('-m', '--missing_image', required=True,
 parser.add_argument('-c', '--confidence_level', required=True, type=int,
                     help='Minimum confidence level to filter '
                          'detections (in percent)')
+parser.add_argument('-j', '--n_jobs', type=int,
+                    default=int(os.environ.get('N_JOBS', 1)),
+                    help='Number of parallel jobs (-1 uses all cores). '
+                         'Defaults to the N_JOBS environment variable, or 1')
+
+# Number of segments aggregated in parallel before saving their rows
+SEGMENTS_PER_CHUNK = 1000
+
+
+def aggregate_segment(segment_id, segment_length, segment_vectors,
+                      segment_image_log, timestamped, time, image_size,
+                      missing_image_normalization, min_confidence_level):
+    """
+    Computes every aggregation for a street segment (for each of its dates if
+    the location is timestamped).
+    :param segment_id: (str)
+    :param segment_length: (float) segment length used to normalize vectors
+    :param segment_vectors: (pd.DataFrame) object vectors of the segment
+    :param segment_image_log: (pd.DataFrame) image log rows of the segment
+    :param timestamped: (bool) whether the location is timestamped
+    :param time: (datetime.date) collection date if not timestamped
+    :param image_size: (int) image resolution
+    :param missing_image_normalization: one of MISSING_IMAGE_NORMALIZATION
+    :param min_confidence_level: (int) minimum detection confidence (percent)
+    :return: (list of tuples) (aggregation, row string) to save, in order
+    """
+    # Set up list of segment_dfs and segment_logs to process
+    segment_dfs = {}
+    segment_logs = {}
+    segment_rows = []
+
+    if timestamped:
+        segment_dates = segment_vectors['img_date'].unique()
+        for date in segment_dates:
+            segment_dfs[date] = \
+                segment_vectors[segment_vectors['img_date'] == date].copy()
+            segment_logs[date] = \
+                segment_image_log[segment_image_log['img_date'] == date].copy()
+    else:
+        segment_dates = [time]
+        segment_dfs[time] = segment_vectors.copy()
+        segment_logs[time] = segment_image_log.copy()
+
+    # Handle case of segments with zero imagery. Note: Even though this is
+    # accounted for below, we need to do so here as well in case the
+    # segment is timestamped, as we won't step into the for loop.
+    if len(segment_dates) == 0:
+        segment_aggregation = {}
+        for object_class in CLASSES_TO_LABEL.keys():
+            segment_aggregation[object_class] = None
+
+        segment_aggregation = {
+            segment_id: segment_aggregation, 'segment_date': 'None'}
+        row_str = json.dumps(segment_aggregation)
+
+        for aggregation in AGGREGATIONS.keys():
+            segment_rows.append((aggregation, row_str))
+
+    for date in segment_dates:
+        segment_df = segment_dfs[date]
+        segment_log = segment_logs[date]
+
+        # Get number of missing and captured images for the segment
+        segment_missing_images = int(segment_log['missing_image'].sum())
+        segment_captured_imgs = int(segment_log['captured_image'].sum())
+
+        # Handle segments with zero images (this type of row is generated in
+        # 01_detect_segments.py) and images with at least one missing image
+        # if this is the selected missing_image normalization.
+        if (segment_df['img_id'].iloc[0] is np.nan) or (
+                missing_image_normalization == 'mark_missing' and
+                segment_missing_images > 0) or (
+                segment_captured_imgs < MIN_NUMBER_OF_PANORAMAS):
+            missing_aggregation = {}
+            for object_class in CLASSES_TO_LABEL.keys():
+                missing_aggregation[object_class] = None
+            segment_aggregations = {
+                aggregation: missing_aggregation
+                for aggregation in AGGREGATIONS.keys()}
+        else:
+            # Filter for minimum confidence level
+            segment_df_filtered = segment_df[
+                segment_df['confidence'] >=
+                np.float32(min_confidence_level / 100)].copy()
+
+            # Compute all aggregations at once
+            segment_aggregations = aggregate_all(
+                df=segment_df_filtered, img_size=image_size,
+                length=segment_length,
+                num_missing_images=segment_missing_images,
+                num_captured_images=segment_captured_imgs,
+                missing_img_normalization=missing_image_normalization,
+                agg_types=list(AGGREGATIONS.keys()))
+
+        for aggregation in AGGREGATIONS.keys():
+            # Tag with the segment ID
+            segment_aggregation = {
+                segment_id: segment_aggregations[aggregation],
+                'segment_date': str(date)}
+            segment_rows.append((aggregation, json.dumps(segment_aggregation)))
+
+    return segment_rows
+
 
 if __name__ == '__main__':
     # Capture command line arguments
@@ -66,6 +176,7 @@ if __name__ == '__main__':
     images_dir = args['images_dir']
     missing_image_normalization = args['missing_image']
     min_confidence_level = args['confidence_level']
+    n_jobs = args['n_jobs']
 
     # Load files
     print('[INFO] Loading segment dictionary, object vectors and image log.')
@@ -102,9 +213,7 @@ if __name__ == '__main__':
     # Add date information if neighborhood is timestamped
     if timestamped:
         image_dates = image_log.copy()
-        image_dates['image_name'] = image_dates['img_id'].apply(
-            lambda x: '_'.join(x.split('_')[2:4]).split('.')[0] if 'img' in x else None
-        )
+        image_dates['image_name'] = get_image_names(image_dates['img_id'])
         image_dates = image_dates[['segment_id', 'image_name', 'img_date']]
         image_dates = image_dates[image_dates['image_name'].notnull()]
 
@@ -135,112 +244,68 @@ if __name__ == '__main__':
     else:
         key_start = 0
 
+    # Encode object classes in CLASSES_TO_LABEL order once for all segments
+    object_vectors['class'] = object_vectors['class'].cat.set_categories(
+        CLASS_NAMES)
+
+    # Confidences are written with 4 decimals, so float32 is precise enough
+    # and halves the memory moved through the per-segment aggregations
+    object_vectors = object_vectors.astype(
+        {'confidence': 'float32', 'bbox_size': 'float32'}, copy=False)
+
+    # Flag missing and captured images in the image log once.
+    # Note: Missing images are recorded as {segment_id} {NotSaved} {None}
+    # {None} in script 02_collect_street_segment_images.py. We can skip the
+    # case of {segment_id} {UnavailableFirstHeading} {None} {None} and
+    # {segment_id} {UnavailableCoordinates} {None} {None} as they'll be handled
+    # automatically in the 'segments with zero images' case below.
+    image_log['missing_image'] = \
+        (image_log['img_id'] == 'NotSaved') & \
+        (image_log['panoid'].isnull()) & (image_log['img_date'].isnull())
+    image_log['captured_image'] = ~image_log['img_id'].isin(
+        ['NotSaved', 'UnavailableFirstHeading', 'UnavailableCoordinates'])
+
+    # Find the rows of each segment in the object vectors and image log with a
+    # single groupby rather than filtering the full DataFrames for each segment
+    object_vector_rows = object_vectors.groupby(
+        'segment_id', observed=True, sort=False).indices
+    image_log_rows = image_log.groupby(
+        'segment_id', observed=True, sort=False).indices
+
     print('[INFO] Creating vectors for {} street segments.'.format(
         len(segment_dictionary) - key_start))
-    for key in tqdm(range(key_start, len(segment_dictionary))):
-        segment = segment_dictionary[str(key)]
-
-        # Hash segment ID
-        segment_id = json.loads(segment['segment_id'])
-        segment_id = '{}-{}'.format(segment_id[0], segment_id[1])
-
-        # Get segment length to normalize vectors
-        segment_length = float(segment['length'])
-
-        # Set up list of segment_dfs and segment_logs to process
-        segment_dfs = {}
-        segment_logs = {}
-
-        if timestamped:
-            segment_dates = object_vectors[
-                object_vectors['segment_id'] == segment_id]['img_date'].unique()
-            for date in segment_dates:
-                segment_dfs[date] = \
-                    object_vectors[(object_vectors['segment_id'] == segment_id) &
-                                   (object_vectors['img_date'] == date)].copy()
-                segment_logs[date] = \
-                    image_log[(image_log['segment_id'] == segment_id) &
-                              (image_log['img_date'] == date)].copy()
-        else:
-            segment_dates = [time]
-            segment_dfs[time] = \
-                object_vectors[object_vectors['segment_id'] == segment_id].copy()
-            segment_logs[time] = \
-                image_log[image_log['segment_id'] == segment_id].copy()
-
-        # Handle case of segments with zero imagery. Note: Even though this is
-        # accounted for below, we need to do so here as well in case the
-        # segment is timestamped, as we won't step into the for loop.
-        if len(segment_dates) == 0:
-            segment_aggregation = {}
-            for object_class in CLASSES_TO_LABEL.keys():
-                segment_aggregation[object_class] = None
-
-            segment_aggregation = {
-                segment_id: segment_aggregation, 'segment_date': 'None'}
-            row_str = json.dumps(segment_aggregation)
-
-            for aggregation in AGGREGATIONS.keys():
-                # Save to file
-                agg_logger = aggregation_files[aggregation]
-                agg_logger.write(row_str)
-
-        for date in segment_dates:
-            segment_df = segment_dfs[date]
-            segment_log = segment_logs[date]
-
-            # Get record of images for the segment to compute missing images.
-            # Note: Missing images are recorded as {segment_id} {NotSaved}
-            # {None} {None} in script 02_collect_street_segment_images.py. We
-            # can skip the case of {segment_id} {UnavailableFirstHeading} {None}
-            # {None} and {segment_id} {UnavailableCoordinates} {None} {None} as
-            # they'll be handled automatically in the 'segments with zero
-            # images' case below.
-            segment_missing_images = segment_log[
-                (segment_log['img_id'] == 'NotSaved') &
-                (segment_log['panoid'].isnull()) & (segment_log['img_date'].isnull())]
-            segment_missing_images = len(segment_missing_images)
-
-            # Get number of captured images for the segment
-            segment_captured_imgs = segment_log[
-                ~segment_log['img_id'].isin(['NotSaved', 'UnavailableFirstHeading',
-                                             'UnavailableCoordinates'])].copy()
-            segment_captured_imgs = len(segment_captured_imgs)
-
-            for aggregation in AGGREGATIONS.keys():
-                # Compute aggregation and save to file
-                agg_function = AGGREGATIONS[aggregation]
-
-                # Handle segments with zero images (this type of row is generated in
-                # 01_detect_segments.py line 152) and images with at least one
-                # missing image if this is the selected missing_image normalization.
-                if (segment_df['img_id'].iloc[0] is np.nan) or (
-                        missing_image_normalization == 'mark_missing' and
-                        segment_missing_images > 0) or (
-                        segment_captured_imgs < MIN_NUMBER_OF_PANORAMAS):
-                    segment_aggregation = {}
-                    for object_class in CLASSES_TO_LABEL.keys():
-                        segment_aggregation[object_class] = None
-                else:
-                    # Filter for minimum confidence level
-                    segment_df_filtered = segment_df[
-                        segment_df['confidence'] >= min_confidence_level / 100].copy()
-
-                    segment_aggregation = agg_function(
-                        df=segment_df_filtered, img_size=image_size,
-                        length=segment_length,
-                        num_missing_images=segment_missing_images,
-                        num_captured_images=segment_captured_imgs,
-                        missing_img_normalization=missing_image_normalization)
-
-                # Tag with the segment ID
-                segment_aggregation = {
-                    segment_id: segment_aggregation, 'segment_date': str(date)}
-                row_str = json.dumps(segment_aggregation)
-
-                # Save to file
-                agg_logger = aggregation_files[aggregation]
-                agg_logger.write(row_str)
+    try:
+        with Parallel(n_jobs=n_jobs) as parallel:
+            for chunk_start in tqdm(range(
+                    key_start, len(segment_dictionary), SEGMENTS_PER_CHUNK)):
+                chunk_segments = [segment_dictionary[str(key)] for key in range(
+                    chunk_start, min(chunk_start + SEGMENTS_PER_CHUNK,
+                                     len(segment_dictionary)))]
+
+                # Hash segment IDs
+                chunk_segment_ids = [
+                    '{}-{}'.format(*json.loads(segment['segment_id']))
+                    for segment in chunk_segments]
+
+                # Aggregate the chunk's segments in parallel
+                chunk_rows = parallel(
+                    delayed(aggregate_segment)(
+                        segment_id, float(segment['length']),
+                        object_vectors.iloc[object_vector_rows.get(segment_id, [])],
+                        image_log.iloc[image_log_rows.get(segment_id, [])],
+                        timestamped, time, image_size, missing_image_normalization,
+                        min_confidence_level)
+                    for segment_id, segment in zip(chunk_segment_ids, chunk_segments))
+
+                # Save to file in segment order
+                for segment_rows in chunk_rows:
+                    for aggregation, row_str in segment_rows:
+                        aggregation_files[aggregation].write(row_str)
+                for agg_logger in aggregation_files.values():
+                    agg_logger.flush()
+    finally:
+        for agg_logger in aggregation_files.values():
+            agg_logger.close()
 
     # Save temporary files as DataFrames
     print('[INFO] Segment representations generated. Exporting temporary files'
@@ -262,11 +327,10 @@ if __name__ == '__main__':
 
         # Export if all segments have been processed
         if number_of_processed_segments == len(segment_dictionary):
-            # Create base DataFrame
-            df_cols = {'segment_id': [], 'segment_date': []}
-            for object_class in CLASSES_TO_LABEL.keys():
-                df_cols[object_class] = []
-            segment_representations = pd.DataFrame(df_cols)
+            # Collect one row per segment and build the DataFrame once
+            df_cols = ['segment_id', 'segment_date'] + list(
+                CLASSES_TO_LABEL.keys())
+            segment_rows = []
 
             # Loop over each segment
             for segment in vector_representations:
@@ -278,8 +342,10 @@ if __name__ == '__main__':
                 for key, item in segment_dict[segment_id].items():
                     new_segment_dict[key] = item
 
-                segment_representations = segment_representations.append(
-                    new_segment_dict, ignore_index=True)
+                segment_rows.append(new_segment_dict)
+
+            segment_representations = pd.DataFrame(
+                segment_rows, columns=df_cols)
 
             # Save CSV
             segment_representations.to_csv(agg_new_file, index=False)
@@ -12,14 +12,14 @@
 #
 # Outputs:
 #   - PNG and HTML files including the static and interactive maps saved to
-#     the specified OUTPUT_PATH
+#     the specified OUTPUT_PATH. Maps newer than both the indices file and this
+#     script are not regenerated unless -f (--force) is passed.
 #
 # Note: This script cannot be used for timestamped neighborhoods. Each segment
 # ID must have a unique index row with a single date.
 
 
 import argparse
-import branca.colormap as cm
 import folium
 import geopandas as gpd
 import matplotlib.pyplot as plt
@@ -27,9 +27,11 @@ import numpy as np
 import os
 import osmnx as ox
 import pandas as pd
+import sys
 
 from DataScripts.locations import LOCATIONS
-from DataScripts.urbanchange_utils import generate_location_graph, generate_urbanindex_gdf
+from DataScripts.urbanchange_utils import load_location_graph, generate_urbanindex_gdf
+from DataScripts.urbanchange_utils import output_is_current, step_colors
 
 
 # Parameters
@@ -49,6 +51,8 @@ parser.add_argument('-i', '--index', required=True,
                     help='Index to plot (must match column name in indices.csv)')
 parser.add_argument('-c', '--confidence_level', required=True, type=int,
                     help='Minimum confidence level to filter detections (in percent)')
+parser.add_argument('-f', '--force', action='store_true',
+                    help='Regenerate the maps even if they are up to date')
 
 
 if __name__ == '__main__':
@@ -59,6 +63,7 @@ if __name__ == '__main__':
     missing_image_normalization = args['missing_image']
     index = args['index']
     min_confidence_level = args['confidence_level']
+    force = args['force']
 
     # Grab location and location attributes for plotting
     location_time = indices_dir.split(os.path.sep)[-1]
@@ -71,12 +76,13 @@ if __name__ == '__main__':
                         ' locations.')
 
     # Load indices and index column
+    indices_file = os.path.join(
+        indices_dir, 'indices_{}_{}_{}.csv'.format(
+            aggregation_type, missing_image_normalization,
+            str(min_confidence_level)))
     try:
         print('[INFO] Loading indices for {}'.format(location_time))
-        with open(os.path.join(
-                indices_dir, 'indices_{}_{}_{}.csv'.format(
-                    aggregation_type, missing_image_normalization,
-                    str(min_confidence_level))), 'r') as file:
+        with open(indices_file, 'r') as file:
             index_data = pd.read_csv(file)
     except FileNotFoundError:
         raise Exception('[ERROR] Indices for location-time not found.')
@@ -86,8 +92,24 @@ if __name__ == '__main__':
     except KeyError:
         raise Exception('[ERROR] Index not found in Indices DataFrame.')
 
-    # Generate graph and prepare edge data for merge
-    G = generate_location_graph(neighborhood=neighborhood, simplify=True)
+    # Skip the maps if they were generated after the indices and this script
+    # last changed
+    output_path = os.path.join(indices_dir, 'Maps')
+    interactive_map_file = os.path.join(
+        output_path, 'IntMap_{}_{}_{}_{}.html'.format(
+            index, aggregation_type, missing_image_normalization,
+            str(min_confidence_level)))
+    static_map_file = os.path.join(
+        output_path, 'StaticMap_{}_{}_{}_{}.png'.format(
+            index, aggregation_type, missing_image_normalization,
+            str(min_confidence_level)))
+    if not force and output_is_current(
+            [interactive_map_file, static_map_file], [indices_file, __file__]):
+        print('[INFO] Maps are up to date with the indices file.')
+        sys.exit(0)
+
+    # Load graph and prepare edge data for merge
+    G = load_location_graph(neighborhood=neighborhood, simplify=True)
     _, edge_data = ox.graph_to_gdfs(G)
 
     complete = generate_urbanindex_gdf(edge_data, index_data)
@@ -96,51 +118,35 @@ if __name__ == '__main__':
     complete = complete[complete['length'] >= MIN_LENGTH]
 
     # Add segment id to include in map
-    complete['segment_id'] = complete.apply(
-        lambda row: '{}-{}'.format(row['node0'], row['node1']), axis=1)
+    complete['segment_id'] = \
+        complete['node0'].astype(str) + '-' + complete['node1'].astype(str)
 
     print('[INFO] Generating maps.')
-    output_path = os.path.join(indices_dir, 'Maps')
     if not os.path.exists(output_path):
         print('[INFO] Generating map output path.')
         os.makedirs(output_path)
 
     # Set up color map
     quantiles = complete['index'].quantile([0.20, 0.40, 0.6, 0.80, 1])
-    CMAP_dark = cm.StepColormap(
-        colors=['#15068a', '#b02a8f', '#ed7b51', '#fde724'],
-        vmin=complete['index'].min(),
-        vmax=complete['index'].max(),
-        index=[quantiles[0.20], quantiles[0.40], quantiles[0.60],
-               quantiles[0.80], quantiles[1.00]]
-    )
-
-    CMAP_light = cm.StepColormap(
-        colors=['#15068a', '#b02a8f', '#ed7b51', '#fde724'],
-        vmin=complete['index'].min(),
-        vmax=complete['index'].max(),
-        index=[quantiles[0.20], quantiles[0.40], quantiles[0.60],
-               quantiles[0.80], quantiles[1.00]]
-    )
-
-    # Interactive map
-    style_fun = lambda x: {'color': CMAP_dark(x['properties']['index']), 'weight': '1'}
-    marker_popup = folium.GeoJsonPopup(fields=['segment_id'])
+    index_colors = ['#15068a', '#b02a8f', '#ed7b51', '#fde724']
+    color_index = [quantiles[0.20], quantiles[0.40], quantiles[0.60],
+                   quantiles[0.80], quantiles[1.00]]
     gdf = gpd.GeoDataFrame(complete, geometry='geometry')
+    gdf['color'] = step_colors(
+        gdf['index'], colors=index_colors, index=color_index)
+
+    # Interactive map. Only the columns used by the style and popup are
+    # serialized to GeoJSON.
+    style_fun = lambda x: {'color': x['properties']['color'], 'weight': '1'}
+    marker_popup = folium.GeoJsonPopup(fields=['segment_id'])
     interactive_map = folium.Map(
         neighborhood['start_location'], zoom_start=13, tiles='CartoDb dark_matter')
-    folium.GeoJson(gdf, style_function=style_fun, popup=marker_popup).add_to(interactive_map)
-    interactive_map.save(os.path.join(output_path, 'IntMap_{}_{}_{}_{}.html'.format(
-        index, aggregation_type, missing_image_normalization,
-        str(min_confidence_level))))
+    folium.GeoJson(gdf[['segment_id', 'color', 'geometry']],
+                   style_function=style_fun, popup=marker_popup).add_to(interactive_map)
+    interactive_map.save(interactive_map_file)
 
     # Static map
-    gdf['color'] = gdf.apply(lambda row: CMAP_light(row['index']), axis=1)
-
     fig, ax = plt.subplots(figsize=(10, 10))
     gdf.plot(ax=ax, color=gdf['color'])
     plt.axis('off')
-    plt.savefig(os.path.join(
-        output_path, 'StaticMap_{}_{}_{}_{}.png'.format(
-            index, aggregation_type, missing_image_normalization,
-            str(min_confidence_level))))
+    plt.savefig(static_map_file)
@@ -27,7 +27,7 @@ from shapely.geometry import Point
 from tqdm import tqdm
 
 from DataScripts.locations import LOCATIONS
-from DataScripts.urbanchange_utils import compute_heading
+from DataScripts.urbanchange_utils import compute_headings
 from DataScripts.urbanchange_utils import generate_new_latlng_from_distance
 from DataScripts.urbanchange_utils import generate_location_graph, AppendLogger
 
@@ -89,12 +89,13 @@ def check_coordinate_bounds(cur_lat, cur_lng, next_lat, next_lng, new_lat, new_l
 
 def get_edge_bearing(cur_lat, cur_lng, next_lat, next_lng):
     """
-    Returns the bearing for a given edge defined by two nodes.
+    Returns the bearing and headings for a given edge defined by two nodes.
     :param cur_lng: (float)
     :param cur_lat: (float)
     :param next_lng: (float)
     :param next_lat: (float)
-    :return: (float)
+    :return: (tuple) of the bearing (float) and the two headings (float, or
+    None if the bearing is missing)
     """
     # Get current Point and next Points
     cur_point, next_point = Point(cur_lng, cur_lat), Point(next_lng, next_lat)
@@ -104,11 +105,12 @@ def get_edge_bearing(cur_lat, cur_lng, next_lat, next_lng):
     subsegments = subsegments[
         (subsegments['node1'] == cur_point) & (subsegments['node2'] == next_point)]
 
-    # Get bearing
-    if len(subsegments) == 1:
-        return subsegments.iloc[0]['bearing']
+    # Get bearing and headings
+    if len(subsegments) == 1 and pd.notna(subsegments.iloc[0]['bearing']):
+        subsegment = subsegments.iloc[0]
+        return subsegment['bearing'], subsegment['heading1'], subsegment['heading2']
     else:
-        return np.nan
+        return np.nan, None, None
 
 
 def generate_latlng(linestring, bearing, visualize):
@@ -147,8 +149,8 @@ def generate_latlng(linestring, bearing, visualize):
             next_lng, next_lat = line_segment_coords[i + 1]
 
         # Get the headings for the current node
-        cur_bearing = get_edge_bearing(cur_lat, cur_lng, next_lat, next_lng)
-        heading1, heading2 = compute_heading(cur_bearing)
+        cur_bearing, heading1, heading2 = get_edge_bearing(
+            cur_lat, cur_lng, next_lat, next_lng)
 
         # Add the current node to the list of coordinates
         GSV_tuples.append(((cur_lat, cur_lng), heading1, heading2))
@@ -244,6 +246,10 @@ street_segments_full[['node1']] = street_segments_full['geometry'].apply(
 street_segments_full[['node2']] = street_segments_full['geometry'].apply(
     lambda x: Point(np.array(x.coords[1], dtype=object)))
 
+# Compute the Google Street View headings for each subsegment
+street_segments_full['heading1'], street_segments_full['heading2'] = \
+    compute_headings(street_segments_full['bearing'])
+
 # Reset index
 street_segments.reset_index(inplace=True)
 
@@ -261,22 +267,24 @@ print('[INFO] Initiating street segment coordinate generation '
 
 print('[INFO] Generating coordinates for {} street segments.'.format(
     len(street_segments) - row_start))
-for row in tqdm(range(row_start, len(street_segments))):
-    # Get row data
-    segment_id = street_segments.iloc[row]['segment_id']
-    name = street_segments.iloc[row]['name']
-    length = street_segments.iloc[row]['length']
-    bearing = round(street_segments.iloc[row]['bearing'], 2)
-    geometry = street_segments.iloc[row]['geometry']
-
-    # Generate coordinates
-    coords = generate_latlng(geometry, bearing, visualize=False)
-
-    # Save to temporary file
-    row_dict = {row: {'segment_id': segment_id, 'name': name, 'length': length,
-                'bearing': bearing, 'coordinates': coords}}
-    row_str = json.dumps(row_dict)
-    temporary_data.write(row_str)
+with temporary_data:
+    for row in tqdm(range(row_start, len(street_segments))):
+        # Get row data
+        segment_id = street_segments.iloc[row]['segment_id']
+        name = street_segments.iloc[row]['name']
+        length = street_segments.iloc[row]['length']
+        bearing = round(street_segments.iloc[row]['bearing'], 2)
+        geometry = street_segments.iloc[row]['geometry']
+
+        # Generate coordinates
+        coords = generate_latlng(geometry, bearing, visualize=False)
+
+        # Save to temporary file
+        row_dict = {row: {'segment_id': segment_id, 'name': name, 'length': length,
+                    'bearing': bearing, 'coordinates': coords}}
+        row_str = json.dumps(row_dict)
+        temporary_data.write(row_str)
+        temporary_data.flush()
 
 # Visualize street segments in the neighborhood
 if VISUALIZE:
@@ -36,7 +36,7 @@ import streetview
 from tqdm import tqdm
 
 import DataScripts.CONFIG as CONFIG
-from DataScripts.urbanchange_utils import get_SV_image, get_SV_metadata
+from DataScripts.urbanchange_utils import get_SV_metadata, save_SV_images
 from DataScripts.urbanchange_utils import AppendLogger, Logger
 from DataScripts.read_files import load_segment_dict, prep_image_log
 
@@ -55,6 +55,11 @@ PERIOD_SELECTION = {
 }
 SEGMENT_RESTRICTION = None
 
+# Concurrent image downloads and maximum downloads per second. Lower these if
+# requests are rejected for exceeding the API key's quota.
+DOWNLOAD_WORKERS = 8
+DOWNLOAD_QPS = 20
+
 # Set up image parameters and output directory
 if TIME_PERIOD == 'google_default':
     OUTPUT_PATH = os.path.join(
@@ -151,6 +156,7 @@ if TIME_PERIOD == 'selected':
         'Optimal date: {}\nMinimum date: {} \nMaximum date: {}'.format(
             PERIOD_SELECTION['optimal_date'], PERIOD_SELECTION['min'],
             PERIOD_SELECTION['max']))
+    date_logger.close()
     print('[INFO] Saving one panorama per location.')
 elif TIME_PERIOD == 'full':
     date_logger = Logger(os.path.join(OUTPUT_PATH, 'image_dates.txt'))
@@ -158,6 +164,7 @@ elif TIME_PERIOD == 'full':
         'Loading all available panoramas per location.\n'
         'Minimum date: {} \nMaximum date: {}'.format(
             PERIOD_SELECTION['min'], PERIOD_SELECTION['max']))
+    date_logger.close()
     print('[INFO] Saving all available panoramas per location.')
 
 # Determine restricted segments. These are segments that are 'out of bounds'
@@ -215,142 +222,158 @@ if os.path.exists(os.path.join(OUTPUT_PATH, 'images.txt')):
 print('[INFO] Saving images for {} street segments.'.format(
     len(segment_dictionary) - start_key))
 
-for key in tqdm(range(start_key, len(segment_dictionary))):
-    segment = segment_dictionary[str(key)]
-
-    # Hash segment ID
-    segment_id = json.loads(segment['segment_id'])
-    segment_id = '{}-{}'.format(segment_id[0], segment_id[1])
-
-    # Skip segment if segment is restricted
-    if segment_id in restricted_segments:
-        print('[INFO] Restricted segment {}: {}'.format(key, segment['name']))
-        coordinate_unavailable_counter += 1
-        image_log = '{} RestrictedSegment NA NA NA NA NA END'.format(segment_id)
-        logger.write(image_log)
-        continue
-
-    # Check segment coordinates
-    if len(segment['coordinates']) == 0:
-        print('[WARNING] No coordinates for segment {}: {}'.format(
-            key, segment['name']))
-        coordinate_unavailable_counter += 1
-        image_log = '{} UnavailableCoordinates NA NA NA NA NA END'.format(segment_id)
-        logger.write(image_log)
-        continue
-
-    # Get images for each coordinate and heading
-    location_counter, query_counter = 0, 0
-    panorama_dict = {}
-
-    # These will be used in case a node has no heading information
-    previous_headings = None, None
-
-    # Drop segments with unavailable headings at first node
-    if segment['coordinates'][0][1] is None or segment['coordinates'][0][2] is None:
-        heading_unavailable_counter += 1
-        image_log = '{} UnavailableFirstHeading NA NA NA NA NA END'.format(segment_id)
-        logger.write(image_log)
-        continue
-
-    for i, ((lat, lng), heading1, heading2) in enumerate(segment['coordinates']):
-        # Create a for list of panoramas to be processed. It will be of length 1
-        # if TIME_PERIOD is not 'full')
-        panos_to_process = []
-        if TIME_PERIOD in ['selected', 'full']:
-            time_panos = PANOID_RETURN_DICT[TIME_PERIOD](lat, lng)
-            if isinstance(time_panos, dict):
-                time_panos = [time_panos]
-
-            for time_pano in time_panos:
-                img_params = IMG_PARAMS.copy()
-                img_params['pano'] = time_pano['pano_id']
-                panos_to_process.append(img_params)
+try:
+    for key in tqdm(range(start_key, len(segment_dictionary))):
+        segment = segment_dictionary[str(key)]
 
-        elif TIME_PERIOD == 'google_default':
-            img_params = IMG_PARAMS.copy()
-            img_params['location'] = '{},{}'.format(lat, lng)
-            panos_to_process.append(img_params)
-        else:
-            raise Exception('[ERROR] TIME_PERIOD should be one of '
-                            '[google_default, selected, full]')
-
-        # Register if imagery is unavailable
-        if len(panos_to_process) == 0:
-            image_panoid, image_date, image_lat, image_lng = None, None, None, None
-            for x in range(2):
-                image_unavailable_counter += 1
-                image_log = '{} NotSaved {} {} {} {} {} END'.format(
-                    segment_id, image_panoid, image_date, query_counter,
-                    image_lat, image_lng)
-                logger.write(image_log)
-                query_counter += 1
+        # Hash segment ID
+        segment_id = json.loads(segment['segment_id'])
+        segment_id = '{}-{}'.format(segment_id[0], segment_id[1])
 
-        for pano_params in panos_to_process:
-            image_metadata = get_SV_metadata(params=pano_params)
+        # Skip segment if segment is restricted
+        if segment_id in restricted_segments:
+            print('[INFO] Restricted segment {}: {}'.format(key, segment['name']))
+            coordinate_unavailable_counter += 1
+            image_log = '{} RestrictedSegment NA NA NA NA NA END'.format(segment_id)
+            logger.write(image_log)
+            logger.flush()
+            continue
 
-            # Get image date, panoid and coordinates if imagery is available
-            if image_metadata['status'] != 'OK':
-                image_panoid, image_date, image_lat, image_lng = None, None, None, None
+        # Check segment coordinates
+        if len(segment['coordinates']) == 0:
+            print('[WARNING] No coordinates for segment {}: {}'.format(
+                key, segment['name']))
+            coordinate_unavailable_counter += 1
+            image_log = '{} UnavailableCoordinates NA NA NA NA NA END'.format(segment_id)
+            logger.write(image_log)
+            logger.flush()
+            continue
+
+        # Get images for each coordinate and heading
+        location_counter, query_counter = 0, 0
+        panorama_dict = {}
+        segment_images, segment_image_files, segment_logs = [], [], []
+
+        # These will be used in case a node has no heading information
+        previous_headings = None, None
+
+        # Drop segments with unavailable headings at first node
+        if segment['coordinates'][0][1] is None or segment['coordinates'][0][2] is None:
+            heading_unavailable_counter += 1
+            image_log = '{} UnavailableFirstHeading NA NA NA NA NA END'.format(segment_id)
+            logger.write(image_log)
+            logger.flush()
+            continue
+
+        for i, ((lat, lng), heading1, heading2) in enumerate(segment['coordinates']):
+            # Create a for list of panoramas to be processed. It will be of length 1
+            # if TIME_PERIOD is not 'full')
+            panos_to_process = []
+            if TIME_PERIOD in ['selected', 'full']:
+                time_panos = PANOID_RETURN_DICT[TIME_PERIOD](lat, lng)
+                if isinstance(time_panos, dict):
+                    time_panos = [time_panos]
+
+                for time_pano in time_panos:
+                    img_params = IMG_PARAMS.copy()
+                    img_params['pano'] = time_pano['pano_id']
+                    panos_to_process.append(img_params)
+
+            elif TIME_PERIOD == 'google_default':
+                img_params = IMG_PARAMS.copy()
+                img_params['location'] = '{},{}'.format(lat, lng)
+                panos_to_process.append(img_params)
             else:
-                image_date = date(int(image_metadata['date'].split('-')[0]),
-                                  int(image_metadata['date'].split('-')[1]), 1)
-                image_panoid = image_metadata['pano_id']
-                image_lat = image_metadata['location']['lat']
-                image_lng = image_metadata['location']['lng']
-
-            # Get the image for each heading from this panorama
-            for heading_num, heading in enumerate([heading1, heading2]):
-                # Check if heading is None
-                if heading is None:
-                    heading = previous_headings[heading_num]
-                pano_params['heading'] = heading
-
-                # Missing imagery for the selected time-location
-                save = True
-                if image_panoid is None:
-                    save = False
+                raise Exception('[ERROR] TIME_PERIOD should be one of '
+                                '[google_default, selected, full]')
+
+            # Register if imagery is unavailable
+            if len(panos_to_process) == 0:
+                image_panoid, image_date, image_lat, image_lng = None, None, None, None
+                for x in range(2):
                     image_unavailable_counter += 1
-                else:
-                    # Check if the image's view of the location is unique by comparing
-                    # to previously queried headings
-                    if image_panoid in panorama_dict.keys():
-                        # Check queried headings
-                        for queried_heading in panorama_dict[image_panoid]:
-                            if abs(queried_heading - heading) < 50:
-                                save = False
-                        # Add current heading if unique
-                        if save:
-                            panorama_dict[image_panoid].append(heading)
-                    else:
-                        panorama_dict[image_panoid] = [heading]
-
-                # Save if available and unique
-                if save:
-                    image = get_SV_image(params=pano_params)
-                    file_name = 'img_{}_h{}_{}.png'.format(
-                        segment_id, heading_num, str(location_counter).zfill(3))
-                    image.save(os.path.join(OUTPUT_PATH, file_name))
-
-                    # Increase counters
-                    location_counter += 1
-                    main_counter += 1
-
-                    image_log = '{} {} {} {} {} {} {} END'.format(
-                        segment_id, file_name, image_panoid, image_date,
-                        query_counter, image_lat, image_lng)
-                else:
                     image_log = '{} NotSaved {} {} {} {} {} END'.format(
                         segment_id, image_panoid, image_date, query_counter,
                         image_lat, image_lng)
+                    segment_logs.append(image_log)
+                    query_counter += 1
 
-                # Log image metadata
-                logger.write(image_log)
-                query_counter += 1
+            for pano_params in panos_to_process:
+                image_metadata = get_SV_metadata(params=pano_params)
 
-        # Update headings if not None
-        if heading1 is not None and heading2 is not None:
-            previous_headings = heading1, heading2
+                # Get image date, panoid and coordinates if imagery is available
+                if image_metadata['status'] != 'OK':
+                    image_panoid, image_date, image_lat, image_lng = None, None, None, None
+                else:
+                    image_date = date(int(image_metadata['date'].split('-')[0]),
+                                      int(image_metadata['date'].split('-')[1]), 1)
+                    image_panoid = image_metadata['pano_id']
+                    image_lat = image_metadata['location']['lat']
+                    image_lng = image_metadata['location']['lng']
+
+                # Get the image for each heading from this panorama
+                for heading_num, heading in enumerate([heading1, heading2]):
+                    # Check if heading is None
+                    if heading is None:
+                        heading = previous_headings[heading_num]
+                    pano_params['heading'] = heading
+
+                    # Missing imagery for the selected time-location
+                    save = True
+                    if image_panoid is None:
+                        save = False
+                        image_unavailable_counter += 1
+                    else:
+                        # Check if the image's view of the location is unique by comparing
+                        # to previously queried headings
+                        if image_panoid in panorama_dict.keys():
+                            # Check queried headings
+                            for queried_heading in panorama_dict[image_panoid]:
+                                if abs(queried_heading - heading) < 50:
+                                    save = False
+                            # Add current heading if unique
+                            if save:
+                                panorama_dict[image_panoid].append(heading)
+                        else:
+                            panorama_dict[image_panoid] = [heading]
+
+                    # Save if available and unique (images are downloaded
+                    # together once the segment is processed)
+                    if save:
+                        file_name = 'img_{}_h{}_{}.png'.format(
+                            segment_id, heading_num, str(location_counter).zfill(3))
+                        segment_images.append(pano_params.copy())
+                        segment_image_files.append(os.path.join(OUTPUT_PATH, file_name))
+
+                        # Increase counters
+                        location_counter += 1
+                        main_counter += 1
+
+                        image_log = '{} {} {} {} {} {} {} END'.format(
+                            segment_id, file_name, image_panoid, image_date,
+                            query_counter, image_lat, image_lng)
+                    else:
+                        image_log = '{} NotSaved {} {} {} {} {} END'.format(
+                            segment_id, image_panoid, image_date, query_counter,
+                            image_lat, image_lng)
+
+                    # Log image metadata
+                    segment_logs.append(image_log)
+                    query_counter += 1
+
+            # Update headings if not None
+            if heading1 is not None and heading2 is not None:
+                previous_headings = heading1, heading2
+
+        # Download the segment's images and log the segment only once they
+        # are all saved, so a failed download is retried when resuming
+        save_SV_images(segment_images, segment_image_files,
+                       max_workers=DOWNLOAD_WORKERS, max_qps=DOWNLOAD_QPS)
+        for image_log in segment_logs:
+            logger.write(image_log)
+        logger.flush()
+finally:
+    logger.close()
 
 print('[INFO] Image collection complete. '
       'Loaded {} images for {} street segments.\n'
@@ -30,7 +30,6 @@
 from datetime import date
 import folium
 import geopandas as gpd
-import json
 import matplotlib.pyplot as plt
 import numpy as np
 import os
@@ -40,6 +39,8 @@ import streetview
 from tqdm import tqdm
 
 from DataScripts.locations import LOCATIONS
+from DataScripts.read_files import load_segment_dict
+from DataScripts.urbanchange_utils import output_is_current
 
 
 # Parameters
@@ -74,6 +75,12 @@ OUTPUT_PATH = os.path.join(
 neighborhood = LOCATIONS[SELECTED_NEIGHBORHOOD]
 grid = neighborhood['location']
 
+# Period bounds as date ordinals
+PERIOD_STARTS = np.array(
+    [period['start'].toordinal() for period in PERIODS.values()], dtype=np.int64)
+PERIOD_ENDS = np.array(
+    [period['end'].toordinal() for period in PERIODS.values()], dtype=np.int64)
+
 
 # Helper functions
 def query_location(lat, lng):
@@ -89,28 +96,21 @@ def query_location(lat, lng):
     """
     # Get panoramas for the location
     panoid_list = streetview.panoids(lat, lng)
-    available_periods = [0] * len(PERIODS)
-
-    # Check availability for selected periods
-    for panoid in panoid_list:
-        if 'year' in panoid.keys():
-            # Get panoid date
-            pano_date = date(panoid['year'], panoid['month'], 1)
 
-            for t, period in enumerate(list(PERIODS.keys())):
-                if PERIODS[period]['start'] <= pano_date <= PERIODS[period]['end']:
-                    available_periods[t] += 1
+    # Get panoid dates (as ordinals to compare against all periods at once)
+    pano_dates = np.array(
+        [date(panoid['year'], panoid['month'], 1).toordinal()
+         for panoid in panoid_list if 'year' in panoid.keys()], dtype=np.int64)
 
     # Check availability for selected periods
-    selected_period_availability = [1 if p > 0 else 0 for p in available_periods]
+    available_periods = (
+        (PERIOD_STARTS <= pano_dates[:, None]) &
+        (pano_dates[:, None] <= PERIOD_ENDS)).any(axis=0)
+    selected_period_availability = available_periods.astype(int).tolist()
 
     return selected_period_availability
 
 
-def color_marker(year_bool):
-    return 'blue' if year_bool else 'gray'
-
-
 # Track progress
 tqdm.pandas()
 
@@ -132,20 +132,14 @@ if not os.path.exists(INPUT_PATH):
 
     elif LOCATION_TYPE == 'segmentDictionary':
         # Read in segment dictionary
-        print('[INFO] Loading {} segment dictionary.'.format(SELECTED_NEIGHBORHOOD))
-        try:
-            with open(SEGMENT_DICTIONARY, 'r') as file:
-                segments = json.load(file)
-        except FileNotFoundError:
-            raise Exception('[ERROR] Segment dictionary not found.')
+        segments = load_segment_dict(SEGMENT_DICTIONARY)
 
         # Create DataFrame of locations
         print('[INFO] Creating DataFrame with location coordinates.')
-        locations = pd.DataFrame({'lat': [], 'lng': []})
-        for key, segment in tqdm(segments.items()):
-            for (lat, lng), h1, h2 in segment['coordinates']:
-                locations = locations.append(
-                    {'lat': lat, 'lng': lng}, ignore_index=True)
+        locations = pd.DataFrame(
+            [coordinates for segment in tqdm(segments.values())
+             for coordinates, h1, h2 in segment['coordinates']],
+            columns=['lat', 'lng'])
 
     else:
         raise Exception(
@@ -164,44 +158,60 @@ else:
     print('[INFO] Loading locations file from input path.')
     locations = pd.read_csv(INPUT_PATH)
 
-# Generate Point objects and GeoDataFrame
-locations['geometry'] = locations.apply(
-    lambda x: Point(x['lng'], x['lat']), axis=1)
-gdf = gpd.GeoDataFrame(locations, geometry='geometry')
-gdf.crs = "EPSG:4326"
-points = folium.GeoJson(gdf)
-
-# Visualize image availability for each year
-print('[INFO] Generating map with yearly layers.')
-neighborhood_map = folium.Map(
-    location=neighborhood['start_location'], zoom_start=12)
-
-for period in list(PERIODS.keys()):
-    # Create period layer and add its markers
-    layer = folium.FeatureGroup(name=period, show=False)
-    for feature in points.data['features']:
-        if feature['geometry']['type'] == 'Point':
+# Skip the maps if they were generated after the locations file and this
+# script last changed
+map_file = os.path.join(
+    OUTPUT_PATH, '{}_{}.html'.format(SELECTED_NEIGHBORHOOD, LOCATION_TYPE))
+static_map_files = {
+    period: os.path.join(OUTPUT_PATH, 'StaticMap{}_{}_{}.png'.format(
+        SELECTED_NEIGHBORHOOD, LOCATION_TYPE, period))
+    for period in PERIODS.keys()}
+if output_is_current(
+        [map_file, *static_map_files.values()], [INPUT_PATH, __file__]):
+    print('[INFO] Maps are up to date with the locations file.')
+else:
+    # Generate Point objects and GeoDataFrame
+    locations['geometry'] = locations.apply(
+        lambda x: Point(x['lng'], x['lat']), axis=1)
+    gdf = gpd.GeoDataFrame(locations, geometry='geometry')
+    gdf.crs = "EPSG:4326"
+
+    # Visualize image availability for each year
+    print('[INFO] Generating map with yearly layers.')
+    neighborhood_map = folium.Map(
+        location=neighborhood['start_location'], zoom_start=12)
+
+    # Add every queried location once as a gray base layer, so that the
+    # period layers only need to mark the locations with available imagery
+    lats, lngs = locations['lat'].to_numpy(), locations['lng'].to_numpy()
+    base_layer = folium.FeatureGroup(name='Queried locations')
+    for lat, lng in zip(lats, lngs):
+        folium.CircleMarker(
+            location=[lat, lng], radius=1, color='gray').add_to(base_layer)
+    base_layer.add_to(neighborhood_map)
+
+    for period in list(PERIODS.keys()):
+        # Create period layer and add its markers
+        layer = folium.FeatureGroup(name=period, show=False)
+        available = locations[period].to_numpy(dtype=bool)
+        for lat, lng in zip(lats[available], lngs[available]):
             folium.CircleMarker(
-                location=list(reversed(feature['geometry']['coordinates'])),
-                radius=1,
-                color=color_marker(feature['properties'][period])).add_to(layer)
-    layer.add_to(neighborhood_map)
-
-# Add Layer control and save map
-folium.LayerControl().add_to(neighborhood_map)
-neighborhood_map.save(os.path.join(
-    OUTPUT_PATH, '{}_{}.html'.format(SELECTED_NEIGHBORHOOD, LOCATION_TYPE)))
-
-# Static maps
-for period in list(PERIODS.keys()):
-    fig, ax = plt.subplots(figsize=(15, 15))
-    if len(gdf[gdf[period] == 1]) > 0:
-        gdf[gdf[period] == 1].plot(
-            ax=ax, markersize=2, color='#C0C0C0', label='Available')
-    if len(gdf[gdf[period] == 0]) > 0:
-        gdf[gdf[period] == 0].plot(
-            ax=ax, markersize=2, color='#AC0000', label='Unavailable')
-    # plt.legend(prop={'size': 15}, frameon=False, loc='lower center', ncol=2)
-    ax.axis("off")
-    plt.savefig(os.path.join(OUTPUT_PATH, 'StaticMap{}_{}_{}.png'.format(
-        SELECTED_NEIGHBORHOOD, LOCATION_TYPE, period)))
+                location=[lat, lng], radius=1, color='blue').add_to(layer)
+        layer.add_to(neighborhood_map)
+
+    # Add Layer control and save map
+    folium.LayerControl().add_to(neighborhood_map)
+    neighborhood_map.save(map_file)
+
+    # Static maps
+    for period in list(PERIODS.keys()):
+        fig, ax = plt.subplots(figsize=(15, 15))
+        if len(gdf[gdf[period] == 1]) > 0:
+            gdf[gdf[period] == 1].plot(
+                ax=ax, markersize=2, color='#C0C0C0', label='Available')
+        if len(gdf[gdf[period] == 0]) > 0:
+            gdf[gdf[period] == 0].plot(
+                ax=ax, markersize=2, color='#AC0000', label='Unavailable')
+        # plt.legend(prop={'size': 15}, frameon=False, loc='lower center', ncol=2)
+        ax.axis("off")
+        plt.savefig(static_map_files[period])
@@ -21,17 +21,15 @@
 
 
 import folium
-import geopandas as gpd
-import json
 import matplotlib.pyplot as plt
 import os
 import pandas as pd
-from shapely.geometry import Point
 from tqdm import tqdm
 
 import DataScripts.CONFIG as CONFIG
 from DataScripts.locations import LOCATIONS
-from DataScripts.urbanchange_utils import get_SV_metadata
+from DataScripts.read_files import load_segment_dict
+from DataScripts.urbanchange_utils import get_SV_metadata_batch, output_is_current
 
 
 # Parameters
@@ -72,27 +70,23 @@ if not os.path.exists(OUTPUT_PATH):
 # Query segment dictionary coordinates if temporary file does not exist
 if not os.path.exists(INPUT_PATH):
     # Read in segment dictionary
-    print('[INFO] Loading {} segment dictionary.'.format(SELECTED_NEIGHBORHOOD))
-    try:
-        with open(SEGMENT_DICTIONARY, 'r') as file:
-            segments = json.load(file)
-    except FileNotFoundError:
-        raise Exception('[ERROR] Segment dictionary not found.')
+    segments = load_segment_dict(SEGMENT_DICTIONARY)
 
     # Create DataFrame of unique panoramas
     print('[INFO] Creating DataFrame with unique panoramas.')
-    panoramas = pd.DataFrame({'pano_id': [], 'lat': [], 'lng': []})
-    for key, segment in tqdm(segments.items()):
-        for (lat, lng), h1, h2 in segment['coordinates']:
-            img_params['location'] = '{},{}'.format(lat, lng)
-            pano_metadata = get_SV_metadata(params=img_params)
-
-            if pano_metadata['status'] == 'OK':
-                panoramas = panoramas.append(
-                    {'pano_id': pano_metadata['pano_id'],
-                     'lat': pano_metadata['location']['lat'],
-                     'lng': pano_metadata['location']['lng']},
-                    ignore_index=True)
+    # Query the metadata of every coordinate concurrently
+    params_list = [
+        dict(img_params, location='{},{}'.format(lat, lng))
+        for segment in segments.values()
+        for (lat, lng), h1, h2 in segment['coordinates']]
+    panorama_rows = []
+    for pano_metadata in get_SV_metadata_batch(params_list):
+        if pano_metadata['status'] == 'OK':
+            panorama_rows.append(
+                {'pano_id': pano_metadata['pano_id'],
+                 'lat': pano_metadata['location']['lat'],
+                 'lng': pano_metadata['location']['lng']})
+    panoramas = pd.DataFrame(panorama_rows, columns=['pano_id', 'lat', 'lng'])
 
     panoramas.to_csv(INPUT_PATH)
 else:
@@ -102,31 +96,33 @@ else:
 # Drop duplicate panoramas
 panoramas = panoramas.drop_duplicates(subset=['pano_id'])
 
-# Generate Point objects and GeoDataFrame
-panoramas['geometry'] = panoramas.apply(
-    lambda x: Point(x['lng'], x['lat']), axis=1)
-gdf = gpd.GeoDataFrame(panoramas, geometry='geometry')
-gdf.crs = "EPSG:4326"
-points = folium.GeoJson(gdf)
-
-# Visualize GSV steps
-print('[INFO] Generating map of GSV steps.')
-neighborhood_map = folium.Map(
-    location=neighborhood['start_location'], zoom_start=12)
+# Skip the maps if they were generated after the locations file and this
+# script last changed
+map_file = os.path.join(OUTPUT_PATH, '{}.html'.format(SELECTED_NEIGHBORHOOD))
+static_map_file = os.path.join(
+    OUTPUT_PATH, 'StaticMap_{}.png'.format(SELECTED_NEIGHBORHOOD))
+if output_is_current([map_file, static_map_file], [INPUT_PATH, __file__]):
+    print('[INFO] Maps are up to date with the locations file.')
+else:
+    # Visualize GSV steps
+    print('[INFO] Generating map of GSV steps.')
+    neighborhood_map = folium.Map(
+        location=neighborhood['start_location'], zoom_start=12)
 
-for feature in points.data['features']:
-    if feature['geometry']['type'] == 'Point':
+    for lat, lng in zip(panoramas['lat'].to_numpy(), panoramas['lng'].to_numpy()):
         folium.CircleMarker(
-            location=tuple(reversed(feature['geometry']['coordinates'])),
+            location=(lat, lng),
             radius=1,
             color='#336699').add_to(neighborhood_map)
 
-neighborhood_map.save(os.path.join(
-    OUTPUT_PATH, '{}.html'.format(SELECTED_NEIGHBORHOOD)))
-
-# Static map
-fig, ax = plt.subplots(figsize=(15, 15))
-gdf.plot(ax=ax, markersize=2, color='#336699')
-ax.axis("off")
-plt.savefig(os.path.join(OUTPUT_PATH, 'StaticMap_{}.png'.format(
-    SELECTED_NEIGHBORHOOD)))
+    neighborhood_map.save(map_file)
+
+    # Static map
+    # Note: A plain scatter of the panorama coordinates is enough for the static
+    # map, so we skip building Point geometries and a GeoDataFrame.
+    fig, ax = plt.subplots(figsize=(15, 15))
+    ax.scatter(panoramas['lng'].to_numpy(), panoramas['lat'].to_numpy(),
+               s=2, c='#336699')
+    ax.set_aspect('equal')
+    ax.axis("off")
+    plt.savefig(static_map_file)
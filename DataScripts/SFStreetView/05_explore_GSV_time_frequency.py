@@ -112,12 +112,13 @@ segments = load_segment_dict(SEGMENT_DICTIONARY)
 if not os.path.exists(INPUT_PATH):
     # Create DataFrame of locations
     print('[INFO] Creating DataFrame with location coordinates.')
-    locations = pd.DataFrame({'segment_id': [], 'lat': [], 'lng': []})
+    location_rows = []
     for key, segment in tqdm(segments.items()):
         for (lat, lng), h1, h2 in segment['coordinates']:
-            locations = locations.append(
-                {'segment_id': segment['segment_id'],
-                 'lat': lat, 'lng': lng}, ignore_index=True)
+            location_rows.append(
+                {'segment_id': segment['segment_id'], 'lat': lat, 'lng': lng})
+    locations = pd.DataFrame(
+        location_rows, columns=['segment_id', 'lat', 'lng'])
 
     # Query each location
     print('[INFO] Querying each location to check availability.')
@@ -137,7 +138,6 @@ locations_melted = pd.melt(
     locations, id_vars=['segment_id', 'lat', 'lng'], var_name='date',
     value_name='available', ignore_index=True)
 locations_melted['date'] = pd.to_datetime(locations_melted['date'], format='%Y-%m-%d')
-locations_melted['date'] = locations_melted['date'].apply(lambda x: x.date())
 
 # Histogram of date availability
 locations_sum = locations_melted[['date', 'available']].\
@@ -163,7 +163,7 @@ segment_sum = segment_sum[segment_sum['available'] >= 5]
 segment_sum = segment_sum.groupby('date').count().reset_index()
 segment_sum['percentage_av'] = segment_sum['available'] / len(segments)
 
-full_dates = pd.DataFrame({'month': months})
+full_dates = pd.DataFrame({'month': pd.to_datetime(months)})
 full_dates = full_dates.merge(
     segment_sum, how='left', left_on='month', right_on='date')
 
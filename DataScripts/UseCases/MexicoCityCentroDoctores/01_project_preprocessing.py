@@ -1,6 +1,9 @@
+from concurrent.futures import ThreadPoolExecutor
 import json
 import os
 import pandas as pd
+import threading
+import time
 
 from CONFIG import SV_api_key
 from DataScripts.urbanchange_utils import geocode
@@ -17,6 +20,10 @@ SEGMENT_DICTIONARY_FILE = os.path.join(
     'segment_dictionary_MexicoCityCentroDoctores.json'
 )
 SELECTED_NEIGHBORHOOD = 'MexicoCityCentroDoctores'
+MAX_WORKERS = 12  # Number of concurrent geocoding requests
+MAX_QPS = 40  # Stay under the Geocoding API queries-per-second limit
+RETRY_WAIT = 2  # Seconds to wait before retrying a rate-limited request
+MAX_RETRIES = 3  # Retries for requests answered with OVER_QUERY_LIMIT
 
 neighborhood = LOCATIONS[SELECTED_NEIGHBORHOOD]
 ADDRESS_PARAMS = {
@@ -26,26 +33,49 @@ ADDRESS_PARAMS = {
         ','.join(str(coord) for coord in neighborhood['location'][1]))
 }
 
+# Request throttle shared by the geocoding threads
+throttle_lock = threading.Lock()
+next_request_time = time.monotonic()
+
 
 # Helper functions
+def wait_for_request_slot():
+    # Space out requests so that all threads combined stay under MAX_QPS
+    global next_request_time
+    with throttle_lock:
+        now = time.monotonic()
+        wait = next_request_time - now
+        next_request_time = max(now, next_request_time) + 1 / MAX_QPS
+    if wait > 0:
+        time.sleep(wait)
+
+
 def process_address(address):
     parsed_address = address.replace(' ', '+')
 
     address_params = ADDRESS_PARAMS.copy()
     address_params['address'] = parsed_address
-    response = geocode(address_params)
-
-    if response.ok:
-        results = json.loads(response.text)
+    # The Geocoding API reports rate limiting as OVER_QUERY_LIMIT in the
+    # response status, so back off and retry on that status
+    for attempt in range(MAX_RETRIES + 1):
+        wait_for_request_slot()
+        response = geocode(address_params)
+        results = json.loads(response.text) if response.ok else {}
+        if results.get('status') != 'OVER_QUERY_LIMIT' or attempt == MAX_RETRIES:
+            break
+        time.sleep(RETRY_WAIT * (attempt + 1))
+
+    if results.get('status') == 'OK' and len(results['results']) > 0:
         if len(results['results']) > 1:
             print('[WARNING] Multiple results for: {}'.format(address))
-        coordinate_pair = '{},{}'.format(
+        coordinate_pair = (
             results['results'][0]['geometry']['location']['lat'],
             results['results'][0]['geometry']['location']['lng']
         )
         return coordinate_pair
     else:
-        print('[WARNING] No results for: {}'.format(address))
+        print('[WARNING] No results for: {} ({})'.format(
+            address, results.get('status', response.status_code)))
         return None
 
 
@@ -62,14 +92,14 @@ def process_locations(location):
             for key, value in segment_dict.items():
                 if value['segment_id'] == segment_id:
                     for (lat, lng), h1, h2 in value['coordinates']:
-                        coordinates.append('{},{}'.format(lat, lng))
+                        coordinates.append((lat, lng))
 
         return coordinates
     elif loc_type == 'Addresses':
         addresses = locations.split('; ')
         coordinates = []
         for address in addresses:
-            coordinate = process_address(address)
+            coordinate = address_coordinates[address]
             if coordinate is not None:
                 coordinates.append(coordinate)
         return coordinates
@@ -92,16 +122,31 @@ projects = projects[
 # Filter for projects that have specific locations
 projects = projects[projects['Locations'].notnull()]
 
-# Obtain lat, lng coordinates for projects with addresses
+# Obtain lat, lng coordinates for projects with addresses. Each unique address
+# is geocoded once, with the requests issued concurrently.
+unique_addresses = set()
+for location in projects['Locations']:
+    loc_type, locations = location.split(': ')
+    if loc_type == 'Addresses':
+        unique_addresses.update(locations.split('; '))
+unique_addresses = sorted(unique_addresses)
+
+print('[INFO] Geocoding {} addresses.'.format(len(unique_addresses)))
+with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+    address_coordinates = dict(zip(
+        unique_addresses, executor.map(process_address, unique_addresses)))
+
 projects['processed_locations'] = projects['Locations'].apply(process_locations)
 
-# Convert to long format
+# Convert to long format and split the (lat, lng) pairs into columns
 projects = projects.explode('processed_locations', ignore_index=True)
+projects['lat'] = projects['processed_locations'].str[0]
+projects['lng'] = projects['processed_locations'].str[1]
 
 # Select columns
 projects = projects[[
     'COLONIA', 'NOMBRE DEL PROYECTO', 'MONTO', 'Start', 'End', 'Type',
-    'processed_locations']]
+    'lat', 'lng']]
 
 # Save
 projects.to_csv(os.path.join(
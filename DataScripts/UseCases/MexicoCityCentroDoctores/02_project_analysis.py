@@ -1,14 +1,13 @@
-import branca.colormap as cm
 import geopandas as gpd
 from matplotlib.colors import ListedColormap
 import matplotlib.pyplot as plt
 import os
 import osmnx as ox
-from shapely.geometry import Point
 import pandas as pd
 
 from DataScripts.locations import LOCATIONS
-from DataScripts.urbanchange_utils import generate_location_graph, generate_urbanindex_gdf
+from DataScripts.urbanchange_utils import load_location_graph, generate_urbanindex_gdf
+from DataScripts.urbanchange_utils import step_colors
 
 
 # Parameters
@@ -20,6 +19,14 @@ URBAN_INDEX = os.path.join(
     'MexicoCityCentroDoctores_2017-08-01_2019-03-01',
     'indices_count_pano_adjustment_50.csv')
 SELECTED_NEIGHBORHOOD = 'MexicoCityCentroDoctores'
+INDEX_COLORS = ['#15068a', '#b02a8f', '#ed7b51', '#fde724']
+PROJECT_COLORS = {
+    'segments': 'gray',
+    'Painting, waterproofing or other': 'turquoise',
+    'Public lighting': 'khaki',
+    'Street planter installation': 'palegreen',
+    'Street repair': 'crimson'
+}
 OUTPUT_PATH = os.path.join(
     'Outputs', 'UseCases', 'MexicoCityCentroDoctores'
 )
@@ -27,30 +34,25 @@ OUTPUT_PATH = os.path.join(
 
 # Helper functions
 def plot_index_project_selection(
-        edge_data, index_data, project_data, selected_projects, selected_index,
+        segment_data, project_data, selected_projects, selected_index,
         plot_name):
-    # Set up segment data (merge edge and index data)
-    index_data['index'] = index_data[selected_index]
-    complete = generate_urbanindex_gdf(edge_data, index_data)
-    gdf_segments = gpd.GeoDataFrame(complete, geometry='geometry')
+    # Set up segment data (segments with the selected index)
+    gdf_segments = segment_data[segment_data[selected_index].notnull()].copy()
+    gdf_segments['index'] = gdf_segments[selected_index]
 
     # Set up project data
     project_data = project_data[project_data['Type'].isin(selected_projects)]
     gdf_projects = gpd.GeoDataFrame(project_data, geometry='geometry')
 
     # Set up color map
-    quantiles = complete['index'].quantile([0.20, 0.40, 0.6, 0.80, 1])
-    CMAP_dark = cm.StepColormap(
-        colors=['#15068a', '#b02a8f', '#ed7b51', '#fde724'],
-        vmin=complete['index'].min(),
-        vmax=complete['index'].max(),
-        index=[quantiles[0.20], quantiles[0.40], quantiles[0.60],
-               quantiles[0.80], quantiles[1.00]]
-    )
+    quantiles = gdf_segments['index'].quantile([0.20, 0.40, 0.6, 0.80, 1])
+    color_index = [quantiles[0.20], quantiles[0.40], quantiles[0.60],
+                   quantiles[0.80], quantiles[1.00]]
 
     # Generate static map
-    gdf_segments['color'] = gdf_segments.apply(lambda row: CMAP_dark(row['index']), axis=1)
-    gdf_projects['color'] = gdf_projects.apply(lambda row: color_projects(row['Type']), axis=1)
+    gdf_segments['color'] = step_colors(
+        gdf_segments['index'], colors=INDEX_COLORS, index=color_index)
+    gdf_projects['color'] = gdf_projects['Type'].map(PROJECT_COLORS)
 
     fig, ax = plt.subplots(figsize=(10, 10))
     gdf_segments.plot(ax=ax, color=gdf_segments['color'])
@@ -65,14 +67,7 @@ def plot_index_project_selection(
 
 
 def color_projects(geom_type):
-    project_colors = {
-        'segments': 'gray',
-        'Painting, waterproofing or other': 'turquoise',
-        'Public lighting': 'khaki',
-        'Street planter installation': 'palegreen',
-        'Street repair': 'crimson'
-    }
-    return project_colors[geom_type]
+    return PROJECT_COLORS[geom_type]
 
 
 # Load files
@@ -88,7 +83,7 @@ except FileNotFoundError:
 
 # Generate location graph
 neighborhood = LOCATIONS[SELECTED_NEIGHBORHOOD]
-G = generate_location_graph(neighborhood=neighborhood, simplify=True)
+G = load_location_graph(neighborhood=neighborhood, simplify=True)
 _, edges = ox.graph_to_gdfs(G)
 
 # Map projects standalone
@@ -97,14 +92,14 @@ loc_edges.reset_index(inplace=True)
 loc_edges = loc_edges.drop_duplicates(subset=['u', 'v'])
 loc_edges['Type'] = 'segments'
 
-projects['geometry'] = projects['processed_locations'].apply(
-    lambda x: Point(float(x.split(',')[1]), float(x.split(',')[0])))
+projects['geometry'] = gpd.points_from_xy(
+    projects['lng'].to_numpy(), projects['lat'].to_numpy())
 
 gdf_edges = gpd.GeoDataFrame(loc_edges, geometry='geometry')
 gdf_projects = gpd.GeoDataFrame(projects, geometry='geometry')
 
-gdf_edges['color'] = gdf_edges.apply(lambda row: color_projects(row['Type']), axis=1)
-gdf_projects['color'] = gdf_projects.apply(lambda row: color_projects(row['Type']), axis=1)
+gdf_edges['color'] = gdf_edges['Type'].map(PROJECT_COLORS)
+gdf_projects['color'] = gdf_projects['Type'].map(PROJECT_COLORS)
 
 cmap = ListedColormap([color_projects(proj_type) for proj_type in gdf_projects['Type'].unique()])
 
@@ -121,34 +116,39 @@ plt.savefig(os.path.join(OUTPUT_PATH, 'StaticMap_ProjectLocations.png'))
 projects = projects[~projects['COLONIA'].isin(['Centro III', 'Centro IV'])]
 
 # Map projects and urban indices
+# * Merge the segment geometries with all indices once for every plot
+index_cols = list(urban_index.columns.drop('segment_id'))
+complete = generate_urbanindex_gdf(edges, urban_index, index_cols=index_cols)
+gdf_segments_full = gpd.GeoDataFrame(complete, geometry='geometry')
+
 plot_index_project_selection(
-    edges, urban_index, projects,
+    gdf_segments_full, projects,
     ['Painting, waterproofing or other', 'Public lighting',
      'Street planter installation', 'Street repair'],
     'weighted_sum_absoluteChange', 'all')
 
 plot_index_project_selection(
-    edges, urban_index, projects,
+    gdf_segments_full, projects,
     ['Painting, waterproofing or other'],
     'facade_absoluteChange', 'facades')
 
 plot_index_project_selection(
-    edges, urban_index, projects,
+    gdf_segments_full, projects,
     ['Street repair'],
     'pothole_absoluteChange', 'potholes')
 
 plot_index_project_selection(
-    edges, urban_index, projects,
+    gdf_segments_full, projects,
     ['Painting, waterproofing or other', 'Public lighting',
      'Street planter installation', 'Street repair'],
     'weighted_sum_log_absoluteChange', 'all')
 
 plot_index_project_selection(
-    edges, urban_index, projects,
+    gdf_segments_full, projects,
     ['Painting, waterproofing or other'],
     'facade_log_absoluteChange', 'facades')
 
 plot_index_project_selection(
-    edges, urban_index, projects,
+    gdf_segments_full, projects,
     ['Street repair'],
     'pothole_log_absoluteChange', 'potholes')
@@ -16,6 +16,7 @@ OUTPUT_T0 = os.path.join('..', '..', '..',
 OUTPUT_T1 = os.path.join('..', '..', '..',
     'Outputs', 'Detection', 'Res_640', 'SFTenderloin_2021-MM-01',
     'count_pano_adjustment_50.csv')
+CHUNK_SIZE = 1000000  # Number of monthly vectors read at a time
 
 # Create output directories
 for output_file in [OUTPUT_T0, OUTPUT_T1]:
@@ -23,16 +24,26 @@ for output_file in [OUTPUT_T0, OUTPUT_T1]:
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
 
-# Read in the vectors and adjust the date column
-vectors = pd.read_csv(URBAN_VECTORS)
-vectors['date'] = pd.to_datetime(vectors['segment_date'])
-vectors['date'] = vectors['date'].apply(lambda x: x.date())
-vectors['year'] = vectors['date'].apply(lambda x: x.year)
+# Read in the vectors in chunks, accumulating the sums and non-missing counts
+# of each segment and year so that the full monthly panel is never in memory
+sums, counts = [], []
+for vectors in pd.read_csv(URBAN_VECTORS, chunksize=CHUNK_SIZE,
+                           dtype={'segment_id': object},
+                           parse_dates=['segment_date']):
+    vectors['year'] = vectors['segment_date'].dt.year
+    vectors = vectors.drop(columns='segment_date')
+    groups = vectors.groupby(['segment_id', 'year'])
+    chunk_sums = groups.sum(numeric_only=True)
+    sums.append(chunk_sums)
+    counts.append(groups[list(chunk_sums.columns)].count())
 
-# Aggregate the monthly vectors
-annual_vectors = vectors.groupby(['segment_id', 'year']).mean().reset_index()
+# Aggregate the monthly vectors (averages are NA if all values are NA)
+sums = pd.concat(sums).groupby(level=['segment_id', 'year']).sum()
+counts = pd.concat(counts).groupby(level=['segment_id', 'year']).sum()
+annual_vectors = (sums / counts).reset_index()
 
-# Export vectors for 2009 and 2021
-annual_vectors.rename(columns={'year': 'segment_date'})
-annual_vectors[annual_vectors['year'] == 2011].to_csv(OUTPUT_T0, index=False)
-annual_vectors[annual_vectors['year'] == 2021].to_csv(OUTPUT_T1, index=False)
+# Export vectors for 2011 and 2021
+output_files = {2011: OUTPUT_T0, 2021: OUTPUT_T1}
+for year, year_vectors in annual_vectors.groupby('year', sort=False):
+    if year in output_files:
+        year_vectors.to_csv(output_files[year], index=False)
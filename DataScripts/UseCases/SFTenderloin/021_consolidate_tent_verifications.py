@@ -23,23 +23,21 @@ file_dict['0'] = file_dict['0'].iloc[0:1800]
 # Joe 1801-3600
 file_dict['2'] = file_dict['2'].iloc[1800:3600]
 
-# Jesu 3601-4614
-overlap_jesu = file_dict['1'].copy()
-file_dict['1'] = file_dict['1'].iloc[3600:4613]
-
 # Check overlap on Jesu's file. As seen using file_dict['2'].info() Joe
 # completed tent verifications so any additional information would be useful
 # for Jack's tents.
-overlap_jesu = overlap_jesu.iloc[0:1800]
+overlap_jesu = file_dict['1'].iloc[0:1800].copy()
+
+# Jesu 3601-4614
+file_dict['1'] = file_dict['1'].iloc[3600:4613]
 
-for i in range(overlap_jesu.shape[0]):
-    if pd.isna(overlap_jesu.iloc[i]['true_tent']):
-        # Check if Jack has this tent
-        if pd.notna(file_dict['0'].iloc[i]['true_tent']):
-            overlap_jesu.at[i, 'true_tent'] = file_dict['0'].iloc[i]['true_tent']
+# Fill the tents missing in Jesu's file with Jack's verifications (both files
+# list the same tents in the same rows)
+overlap_jesu['true_tent'] = overlap_jesu['true_tent'].combine_first(
+    file_dict['0']['true_tent'])
 
 # Replace Jack's file with the overlap file
-file_dict['0'] = overlap_jesu.copy()
+file_dict['0'] = overlap_jesu
 
 # Concatenate
 selected_cols = list(file_dict['1'].columns)[0:13]
@@ -33,17 +33,17 @@ OUTPUT_DIR = os.path.join(
 object_vectors = prep_object_vectors_with_dates(OBJECT_VECTORS_DIR, IMAGES_DIR)
 
 # Convert dates to datetime
-object_vectors['segment_date'] = pd.to_datetime(object_vectors['img_date'])
-object_vectors['segment_date'] = object_vectors['segment_date'].apply(
-    lambda x: x.date())
+object_vectors['segment_date'] = pd.to_datetime(
+    object_vectors['img_date']).dt.normalize()
 
 # Get tent instances and sort according to confidence level
 tent_vectors = object_vectors[object_vectors['class'] == 'tent'].copy()
 tent_vectors = tent_vectors.sort_values('confidence')
 
 # Generate complete image name to facilitate false positive identification
-tent_vectors['complete_image_name'] = tent_vectors.apply(
-    lambda x: 'img_{}_{}'.format(x['segment_id'], x['img_id']), axis=1)
+tent_vectors['complete_image_name'] = \
+    'img_' + tent_vectors['segment_id'].astype(str) + \
+    '_' + tent_vectors['img_id'].astype(str)
 tent_vectors['true_tent'] = None
 
 # Save CSV
@@ -12,10 +12,11 @@
 #   - Urban index generated by 04_indices_in_time.py
 #
 # Outputs:
-#   - CSV file
+#   - CSV and Parquet files
 
 from datetime import date
 import json
+import numpy as np
 import os
 import pandas as pd
 
@@ -36,7 +37,7 @@ OUTPUT_DIR = os.path.join(
     'Data', 'ProcessedData', 'UseCases', 'SFTenderloin')
 PERIOD = {'start': date(2009, 1, 1), 'end': date(2021, 7, 31)}
 CONFIDENCE_LEVEL = 0
-OUTPUT_NAME = 'base_panel_true.csv'
+OUTPUT_NAME = 'base_panel_true'
 
 
 # Load files
@@ -44,53 +45,50 @@ segment_dictionary = load_segment_dict(SEGMENT_DICTIONARY_FILE)
 
 try:
     with open(TENT_DETECTIONS_FILE, 'r') as file:
-        tent_vectors = pd.read_csv(file)
+        tent_vectors = pd.read_csv(
+            file, usecols=['segment_id', 'img_date', 'true_tent'],
+            dtype={'segment_id': object, 'img_date': object,
+                   'true_tent': np.float64})
 except FileNotFoundError:
     raise Exception('[ERROR] Tent checks file not found.')
 
 # Load selected urban index
 try:
     with open(URBAN_INDEX, 'r') as file:
-        urban_index = pd.read_csv(file)
+        urban_index = pd.read_csv(
+            file, dtype={'segment_id': object}, parse_dates=['segment_date'])
 except FileNotFoundError:
     raise Exception('[ERROR] Urban index file not found.')
 
 # Convert dates to datetime
-tent_vectors['segment_date'] = pd.to_datetime(tent_vectors['img_date'])
-urban_index['segment_date'] = pd.to_datetime(urban_index['segment_date'])
-
-tent_vectors['segment_date'] = tent_vectors['segment_date'].apply(
-    lambda x: x.date())
-urban_index['segment_date'] = urban_index['segment_date'].apply(
-    lambda x: x.date())
+tent_vectors['segment_date'] = pd.to_datetime(
+    tent_vectors['img_date']).dt.normalize()
+urban_index['segment_date'] = urban_index['segment_date'].dt.normalize()
 
 # Filter tent instances for false positives and/or confidence level
 #tent_vectors = tent_vectors[tent_vectors['confidence'] >= CONFIDENCE_LEVEL / 100]
-tent_vectors = tent_vectors[tent_vectors['true_tent'] == '1']
+tent_vectors = tent_vectors[tent_vectors['true_tent'] == 1]
 #tent_vectors = tent_vectors[
 #    ((tent_vectors['confidence'] >= CONFIDENCE_LEVEL / 100) &
-#     (tent_vectors['true_tent'] != '0')) |
-#    (tent_vectors['true_tent'] == '1')]
+#     (tent_vectors['true_tent'] != 0)) |
+#    (tent_vectors['true_tent'] == 1)]
 
 # Aggregate tent detections at the street segment level
-tent_vectors = tent_vectors.groupby(['segment_id', 'segment_date']).size().\
-    reset_index(name='count')
+tent_counts = tent_vectors.groupby(['segment_id', 'segment_date']).size().\
+    rename('count')
 
 # Generate base panel
-months = [ts.date() for ts in pd.date_range(
-    PERIOD['start'], PERIOD['end'], freq='MS')]
-month_df = pd.DataFrame({'segment_date': months})
+months = pd.date_range(PERIOD['start'], PERIOD['end'], freq='MS')
 
-hashed_segments = [
-    json.loads(seg['segment_id']) for seg in segment_dictionary.values()]
-hashed_segments = ['{}-{}'.format(seg_id[0], seg_id[1]) for seg_id in hashed_segments]
-segment_df = pd.DataFrame({'segment_id': hashed_segments})
+hashed_segments = np.array([
+    json.loads(seg['segment_id']) for seg in segment_dictionary.values()]).astype(str)
+hashed_segments = np.char.add(
+    np.char.add(hashed_segments[:, 0], '-'), hashed_segments[:, 1])
+panel_index = pd.MultiIndex.from_product(
+    [hashed_segments, months], names=['segment_id', 'segment_date'])
 
 # Add tent count to base panel
-base_panel = segment_df.merge(month_df, how='cross')
-base_panel = base_panel.merge(
-    tent_vectors[['segment_id', 'segment_date', 'count']],
-    how='left', on=['segment_id', 'segment_date'], validate='one_to_one')
+base_panel = tent_counts.reindex(panel_index).reset_index()
 
 # Add urban index to base panel
 base_panel = base_panel.merge(
@@ -99,11 +97,14 @@ base_panel = base_panel.merge(
 
 # Modify zeros in base panel: We need to identify cases where zero tents
 # were detected, as these are currently fake "nan"s
-base_panel['tent_count'] = base_panel.apply(
-    lambda row: 0 if pd.isnull(row['count']) and pd.notnull(row['tent'])
-    else row['count'],
-    axis=1)
+base_panel['tent_count'] = np.where(
+    base_panel['count'].isnull() & base_panel['tent'].notnull(),
+    0, base_panel['count'])
 
-# Save base panel
+# Save base panel (the Parquet copy keeps column types and is the one read by
+# 04_create_final_panel.py)
 base_panel.drop(labels='count', axis='columns', inplace=True)
-base_panel.to_csv(os.path.join(OUTPUT_DIR, OUTPUT_NAME), index=False)
+base_panel.to_csv(
+    os.path.join(OUTPUT_DIR, '{}.csv'.format(OUTPUT_NAME)), index=False)
+base_panel.to_parquet(
+    os.path.join(OUTPUT_DIR, '{}.parquet'.format(OUTPUT_NAME)), index=False)
@@ -6,10 +6,10 @@
 #   python 04_create_final_panel.py
 #
 # Data inputs:
-#   - Base panel
+#   - Base panel (Parquet file generated by 03_create_base_panel.py)
 #
 # Outputs:
-#   - CSV file
+#   - CSV and Parquet files
 
 import datetime
 from datetime import date
@@ -20,9 +20,10 @@ import pandas as pd
 
 # Parameters
 BASE_PANEL = os.path.join(
-    'Data', 'ProcessedData', 'UseCases', 'SFTenderloin', 'base_panel_true.csv')
+    'Data', 'ProcessedData', 'UseCases', 'SFTenderloin',
+    'base_panel_true.parquet')
 OUTPUT_PANEL = os.path.join(
-    'Data', 'ProcessedData', 'UseCases', 'SFTenderloin', 'final_panel_true.csv')
+    'Data', 'ProcessedData', 'UseCases', 'SFTenderloin', 'final_panel_true')
 LAGS = 1  # Number of period lags
 URBAN_INDEX_COLS = [
     'facade', 'graffiti', 'weed', 'garbage',
@@ -33,125 +34,103 @@ URBAN_INDEX_COLS = [
 
 
 # Helper functions
-def aggregate_sum(x):
-    if x.empty:
-        return None
-    else:
-        # If all values are NA, return NA
-        if np.isnan(x).sum() == len(x):
-            return np.nan
-        else:
-            return np.nansum(x)
-
-
-def aggregate_mean(x):
-    if x.empty:
-        return None
-    else:
-        # If all values are NA, return NA
-        if np.isnan(x).sum() == len(x):
-            return np.nan
-        # Else return mean excluding NA values
-        else:
-            return np.nanmean(x)
-
-
-def generate_indicator(x):
-    if np.isnan(x):
-        return np.nan
-    else:
-        if x > 0:
-            return 1
-        else:
-            return 0
+def generate_indicator(counts):
+    # 1 if there are tents, 0 if there are none and NaN if the count is
+    # missing. Kept as floats so the CSV keeps its 1.0/0.0 formatting.
+    return (counts > 0).astype(np.float64).where(counts.notna())
 
 
 # Load files
 try:
-    with open(BASE_PANEL, 'r') as file:
-        base_panel = pd.read_csv(file)
+    base_panel = pd.read_parquet(BASE_PANEL)
 except FileNotFoundError:
     print('[ERROR] Base panel not found.')
 
 # Convert dates to DateTime
-base_panel['segment_date'] = pd.to_datetime(base_panel['segment_date'])
-base_panel['segment_date'] = base_panel['segment_date'].apply(
-    lambda z: z.date())
+base_panel['segment_date'] = base_panel['segment_date'].dt.normalize()
+
+# Use compact dtypes: segment IDs repeat on every month of the panel, so
+# storing them as categories lets groupbys and lookups use integer codes.
+# Tent counts are whole numbers and are exact as float32.
+base_panel = base_panel.astype(
+    {'segment_id': 'category', 'tent_count': np.float32})
 
 # Add adjacent-segment (2-degree) tent exposure ----------------
-base_panel['node1'] = base_panel['segment_id'].apply(lambda z: z.split('-')[0])
-base_panel['node2'] = base_panel['segment_id'].apply(lambda z: z.split('-')[1])
-
-base_panel_cp = base_panel.copy()
-base_panel_cp.rename(
-    columns={'node1': 'node1r', 'node2': 'node2r', 'tent_count': 'tent_countr'},
-    inplace=True)
-
-# * Generate panel with the tent values of all adjacent street segments
-extended_panel = pd.DataFrame(
-    {col: [] for col in list(base_panel.columns) + ['node1r', 'node2r', 'tent_countr']})
-
-# We have to merge four times, twice for each of the two end nodes, as the
-# nodes may appear in the left or right hand-side of the hashed street segment
-# ID
-for x in range(1, 3):
-    for y in range(1, 3):
-        merged_panel = base_panel.merge(
-            base_panel_cp[['segment_date', 'node1r', 'node2r', 'tent_countr']],
-            how='left', left_on=['node{}'.format(x), 'segment_date'],
-            right_on=['node{}r'.format(y), 'segment_date'])
-        # We will double count the current street segment's tent exposure, as
-        # this combination will appear twice: one for x==y==1 and another for
-        # x==y==2. So we drop it from one of these cases.
-        if x == 1 and y == 1:
-            merged_panel = merged_panel[
-                ~((merged_panel['node{}'.format(x)] == merged_panel['node{}r'.format(y)]) &
-                  (merged_panel['node{}'.format(2 if x == 1 else 1)] == merged_panel[
-                      'node{}r'.format(2 if y == 1 else 1)]))]
-        extended_panel = pd.concat([extended_panel, merged_panel], axis=0)
-
-# * Compute aggregate exposure to tents (including adjacent segments)
-extended_panel = extended_panel. \
-    groupby(['segment_id', 'segment_date', 'tent_count'] + URBAN_INDEX_COLS,
-            dropna=False). \
-    agg({'tent_countr': aggregate_sum}).reset_index()
-extended_panel.rename(columns={'tent_countr': 'tent_count_2d'}, inplace=True)
+# * Arrange tent counts in a segment x month matrix
+segment_codes = base_panel['segment_id'].cat.codes.to_numpy()
+date_codes, dates = pd.factorize(base_panel['segment_date'])
+tent_counts = np.full(
+    (len(base_panel['segment_id'].cat.categories), len(dates)), np.nan,
+    dtype=np.float32)
+tent_counts[segment_codes, date_codes] = base_panel['tent_count'].to_numpy()
+
+# * Match each segment end node with the end nodes of all segments. This
+# covers the nodes appearing on either side of the hashed street segment ID.
+segments = base_panel['segment_id'].cat.categories.str.split(
+    '-', n=1, expand=True).to_frame(index=False, name=['node1', 'node2'])
+segments['segment'] = np.arange(len(segments))
+endpoints = segments.melt(
+    id_vars='segment', value_vars=['node1', 'node2'], var_name='end',
+    value_name='node')
+neighbors = endpoints.merge(endpoints, on='node', suffixes=('', 'r'))
+
+# We will double count the current street segment's tent exposure, as it is
+# matched with itself through both node1 and node2. So we drop the node1 match.
+neighbors = neighbors[
+    ~((neighbors['segment'] == neighbors['segmentr']) &
+      (neighbors['end'] == 'node1') & (neighbors['endr'] == 'node1'))]
+neighbors = neighbors.sort_values('segment')
+
+# * Compute aggregate exposure to tents (including adjacent segments) by
+# summing the neighbors' rows of the tent matrix for each segment. Every
+# segment is its own neighbor, so no segment has an empty group. Sums are NA
+# if all values are NA.
+neighbor_counts = tent_counts[neighbors['segmentr'].to_numpy()]
+group_starts = np.flatnonzero(np.diff(
+    neighbors['segment'].to_numpy(), prepend=-1))
+exposure_sums = np.add.reduceat(
+    np.nan_to_num(neighbor_counts), group_starts, axis=0)
+exposure_observed = np.logical_or.reduceat(
+    ~np.isnan(neighbor_counts), group_starts, axis=0)
+tent_exposure = np.where(exposure_observed, exposure_sums, np.nan)
+
+base_panel['tent_count_2d'] = tent_exposure[
+    segment_codes, date_codes].astype(np.float32)
 
 # Aggregate observations on a quarterly basis -------------------
 # * Generate quarters
-quarterly_panel = extended_panel.copy()
-quarterly_panel['quarter'] = pd.PeriodIndex(
-    quarterly_panel['segment_date'], freq='Q')
+base_panel['quarter'] = pd.PeriodIndex(base_panel['segment_date'], freq='Q')
 
 # * Aggregate on a quarterly basis by summing over tents and averaging the
-# urban index
-quarter_aggregations = {
-    'tent_count': aggregate_sum, 'tent_count_2d': aggregate_sum}
-for col in URBAN_INDEX_COLS:
-    quarter_aggregations[col] = aggregate_mean
-
-quarterly_panel = quarterly_panel.groupby(['segment_id', 'quarter']). \
-    agg(quarter_aggregations).reset_index()
+# urban index (excluding NA values; both are NA if all values are NA)
+quarter_groups = base_panel.groupby(['segment_id', 'quarter'], observed=True)
+quarterly_panel = pd.concat([
+    quarter_groups[['tent_count', 'tent_count_2d']].sum(min_count=1),
+    quarter_groups[URBAN_INDEX_COLS].mean()], axis=1).reset_index()
 
 # Generate final panel with all treatments and outcomes -----------
-final_panel = quarterly_panel.copy()
+final_panel = quarterly_panel
 
-# * Generate treatment lags
+# * Generate treatment lags (grouping the panel by segment only once)
+segment_groups = final_panel.groupby(['segment_id'], observed=True)
+lagged_counts = {}
 for lag in range(1, LAGS + 1):
-    final_panel['tent_count_{}'.format(lag)] = final_panel.groupby(
-        ['segment_id'])['tent_count'].shift(lag)
-    final_panel['tent_count_2d_{}'.format(lag)] = final_panel.groupby(
-        ['segment_id'])['tent_count_2d'].shift(lag)
+    lagged_counts['tent_count_{}'.format(lag)] = \
+        segment_groups['tent_count'].shift(lag)
+    lagged_counts['tent_count_2d_{}'.format(lag)] = \
+        segment_groups['tent_count_2d'].shift(lag)
+final_panel = final_panel.assign(**lagged_counts)
 
 # * Generate tent indicators
-final_panel['tent_indicator'] = final_panel['tent_count']. \
-    apply(generate_indicator)
-final_panel['tent_indicator_2d'] = final_panel['tent_count_2d']. \
-    apply(generate_indicator)
-final_panel['tent_indicator_1'] = final_panel['tent_count_1']. \
-    apply(generate_indicator)
-final_panel['tent_indicator_2d_1'] = final_panel['tent_count_2d_1']. \
-    apply(generate_indicator)
+final_panel['tent_indicator'] = generate_indicator(
+    final_panel['tent_count'])
+final_panel['tent_indicator_2d'] = generate_indicator(
+    final_panel['tent_count_2d'])
+final_panel['tent_indicator_1'] = generate_indicator(
+    final_panel['tent_count_1'])
+final_panel['tent_indicator_2d_1'] = generate_indicator(
+    final_panel['tent_count_2d_1'])
 
 # Save to output directory ----------------------------------------
-final_panel.to_csv(OUTPUT_PANEL, index=False)
+final_panel.to_csv('{}.csv'.format(OUTPUT_PANEL), index=False)
+final_panel.to_parquet('{}.parquet'.format(OUTPUT_PANEL), index=False)
@@ -4,7 +4,7 @@ import os
 import osmnx as ox
 
 from DataScripts.locations import LOCATIONS
-from DataScripts.urbanchange_utils import generate_location_graph, AppendLogger
+from DataScripts.urbanchange_utils import load_location_graph, AppendLogger
 
 OUTPUT_PATH = os.path.join('..', '..', 'Outputs', 'Writeup')
 SELECTED_LOCATION = 'MissionTenderloinAshburyCastroChinatown'
@@ -18,11 +18,11 @@ neighborhood = LOCATIONS[SELECTED_LOCATION]
 neighborhood_wider = LOCATIONS[WIDER_LOCATION]
 
 print('[INFO] loading neighborhood graph')
-G = generate_location_graph(neighborhood=neighborhood, simplify=True)
+G = load_location_graph(neighborhood=neighborhood, simplify=True)
 _, edges = ox.graph_to_gdfs(G)
 
 print('[INFO] loading wider neighborhood graph')
-Gw = generate_location_graph(neighborhood=neighborhood_wider, simplify=True)
+Gw = load_location_graph(neighborhood=neighborhood_wider, simplify=True)
 _, edgesw = ox.graph_to_gdfs(Gw)
 
 gdf = gpd.GeoDataFrame(edges, geometry='geometry')
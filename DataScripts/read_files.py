@@ -2,78 +2,208 @@
 # and other.
 
 import json
+import numpy as np
 import os
 import pandas as pd
-
-
-# Segment dictionary
+import pickle
+import pyarrow as pa
+from pyarrow import csv
+
+# orjson parses large segment dictionaries considerably faster than the
+# standard library; fall back to json if it is not installed
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+# Segment dictionary. A pickled copy is saved next to the JSON file the first
+# time it is parsed and is loaded instead for as long as it is newer than the
+# JSON file. The cache is optional: if it cannot be read the JSON is parsed,
+# and if it cannot be written (e.g. read-only data directory) it is skipped.
 def load_segment_dict(segment_dictionary_file):
+    cache_file = '{}.pkl'.format(segment_dictionary_file)
     try:
         print('[INFO] Loading segment dictionary.')
-        with open(segment_dictionary_file, 'r') as seg_file:
-            segment_dictionary = json.load(seg_file)
+        if os.path.exists(cache_file) and os.path.getmtime(cache_file) > \
+                os.path.getmtime(segment_dictionary_file):
+            try:
+                with open(cache_file, 'rb') as seg_file:
+                    return pickle.load(seg_file)
+            except (OSError, EOFError, pickle.UnpicklingError):
+                pass
+
+        with open(segment_dictionary_file, 'rb') as seg_file:
+            if orjson is not None:
+                segment_dictionary = orjson.loads(seg_file.read())
+            else:
+                segment_dictionary = json.load(seg_file)
     except FileNotFoundError:
         raise Exception('[ERROR] Segment file dictionary not found.')
 
+    # Write to a temporary file and move it into place, so a script loading
+    # the dictionary concurrently never reads a partially written cache
+    temp_file = '{}.{}.tmp'.format(cache_file, os.getpid())
+    try:
+        with open(temp_file, 'wb') as seg_file:
+            pickle.dump(
+                segment_dictionary, seg_file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_file, cache_file)
+    except OSError:
+        if os.path.exists(temp_file):
+            os.remove(temp_file)
+
     return segment_dictionary
 
 
-# Object vectors from detections.csv
+# Strings read as missing values in detections.csv and images.txt
+NULL_VALUES = ['', 'NA', 'N/A', 'NaN', 'nan', 'NULL', 'null', 'None']
+
+
+def sort_categories(df, columns):
+    """
+    Sorts the categories of categorical columns read with pyarrow, which keeps
+    them in order of appearance, as pandas would.
+    :param df: (pd.DataFrame)
+    :param columns: (list of str) categorical columns
+    :return: void (modifies df)
+    """
+    for column in columns:
+        df[column] = df[column].cat.reorder_categories(
+            df[column].cat.categories.sort_values())
+
+
+# Object vectors from detections.parquet. Identifier and class columns repeat
+# across many rows, so they are loaded as categoricals to deduplicate, merge
+# and filter on integer codes instead of strings. Outputs written before the
+# switch to Parquet are read from detections.csv with pyarrow's multithreaded
+# CSV reader, which dictionary-encodes these columns while reading.
 def prep_object_vectors(obj_vectors_dir):
     print('[INFO] Loading object detection vectors.')
-    try:
-        with open(os.path.join(obj_vectors_dir, 'detections.csv'), 'r') as file:
-            object_vectors = pd.read_csv(
-                file, dtype={'segment_id': object, 'img_id': object,
-                             'object_id': object, 'confidence': float,
-                             'bbox_size': float, 'class': object},
-                na_values=['None'])
-    except FileNotFoundError:
-        raise Exception('[ERROR] Object vectors file not found.')
+    parquet_file = os.path.join(obj_vectors_dir, 'detections.parquet')
+    if os.path.exists(parquet_file):
+        object_vectors = pd.read_parquet(parquet_file, engine='pyarrow')
+    else:
+        categorical = pa.dictionary(pa.int32(), pa.string())
+        convert_options = csv.ConvertOptions(
+            column_types={'segment_id': categorical, 'img_id': categorical,
+                          'object_id': pa.string(), 'confidence': pa.float64(),
+                          'bbox_size': pa.float64(), 'class': categorical},
+            null_values=NULL_VALUES, strings_can_be_null=True)
+        try:
+            object_vectors = csv.read_csv(
+                os.path.join(obj_vectors_dir, 'detections.csv'),
+                convert_options=convert_options).to_pandas()
+        except FileNotFoundError:
+            raise Exception('[ERROR] Object vectors file not found.')
+
+    sort_categories(object_vectors, ['segment_id', 'img_id', 'class'])
 
     # Drop duplicate objects (this may be driven by the 01_detect_segments.py
     # process stopping and restarting)
-    object_vectors.drop_duplicates(
-        subset=['segment_id', 'img_id', 'object_id'], inplace=True)
+    object_codes, object_ids = pd.factorize(object_vectors['object_id'])
+    object_key = pack_codes(
+        [object_vectors['segment_id'].cat.codes, object_vectors['img_id'].cat.codes,
+         object_codes],
+        [len(object_vectors['segment_id'].cat.categories),
+         len(object_vectors['img_id'].cat.categories), len(object_ids)])
+    object_vectors = object_vectors[~pd.Index(object_key).duplicated()]
 
     return object_vectors
 
 
-# Image log from images.txt
+def pack_codes(codes, n_categories):
+    """
+    Packs the integer codes of several categorical columns into a single int64
+    key per row, so rows can be hashed, deduplicated or merged on one column.
+    :param codes: (list of np.array) codes for each column, -1 if missing
+    :param n_categories: (list of int) number of categories for each column
+    :return: (np.array) of int64 keys
+    """
+    key = np.zeros(len(codes[0]), dtype=np.int64)
+    for column_codes, n in zip(codes, n_categories):
+        key = key * (n + 1) + (np.asarray(column_codes, dtype=np.int64) + 1)
+    return key
+
+
+# Image log from images.txt, parsed with pyarrow's CSV reader as well
 def prep_image_log(images_dir):
     print('[INFO] Loading image log.')
+    categorical = pa.dictionary(pa.int32(), pa.string())
+    read_options = csv.ReadOptions(
+        skip_rows=1, column_names=['segment_id', 'img_id', 'panoid', 'img_date',
+                                   'query_id', 'pano_lat', 'pano_lng', 'END'])
+    convert_options = csv.ConvertOptions(
+        column_types={'segment_id': categorical, 'img_id': pa.string(),
+                      'panoid': categorical, 'img_date': pa.string(),
+                      'pano_lat': pa.float64(), 'pano_lng': pa.float64(),
+                      'END': pa.string()},
+        null_values=NULL_VALUES, strings_can_be_null=True)
     try:
-        with open(os.path.join(images_dir, 'images.txt'), 'r') as file:
-            image_log = pd.read_csv(
-                file, sep=' ', header=0,
-                names=['segment_id', 'img_id', 'panoid', 'img_date', 'query_id',
-                       'pano_lat', 'pano_lng', 'END'],
-                na_values=['None'])
+        image_log = csv.read_csv(
+            os.path.join(images_dir, 'images.txt'), read_options=read_options,
+            parse_options=csv.ParseOptions(delimiter=' '),
+            convert_options=convert_options).to_pandas()
     except FileNotFoundError:
         raise Exception('[ERROR] images.txt file not found.')
 
+    sort_categories(image_log, ['segment_id', 'panoid'])
+
     # Remove duplicate lines in images log (driven by interrupting the image
     # collection process)
-    image_log = image_log.drop_duplicates(subset=['segment_id', 'query_id'])
+    query_codes, query_ids = pd.factorize(image_log['query_id'])
+    image_key = pack_codes(
+        [image_log['segment_id'].cat.codes, query_codes],
+        [len(image_log['segment_id'].cat.categories), len(query_ids)])
+    image_log = image_log[~pd.Index(image_key).duplicated()]
 
     return image_log
 
 
+def get_image_names(img_ids):
+    """
+    Extracts the image names used in the object vectors from the img_id
+    column of the image log, e.g. 'pano_x_img_3_0.png' -> 'img_3'.
+    :param img_ids: (pd.Series) img_id column of the image log
+    :return: (pd.Series) image names, missing for ids without an image
+    """
+    # Equivalent to '_'.join(x.split('_')[2:4]).split('.')[0] for each id
+    image_names = img_ids.str.extract(
+        r'^(?:[^_]*_){2}([^_.]*(?:_[^_.]*)?)', expand=False).fillna('')
+    return image_names.where(img_ids.str.contains('img', regex=False))
+
+
 def prep_object_vectors_with_dates(obj_vectors_dir, images_dir):
     object_vectors = prep_object_vectors(obj_vectors_dir)
     image_log = prep_image_log(images_dir)
 
     # Get image dates
     image_dates = image_log.copy()
-    image_dates['image_name'] = image_dates['img_id'].apply(
-        lambda x: '_'.join(x.split('_')[2:4]).split('.')[0] if 'img' in x else None)
+    image_dates['image_name'] = get_image_names(image_dates['img_id'])
     image_dates = image_dates[[
         'segment_id', 'image_name', 'img_date', 'pano_lat', 'pano_lng']]
     image_dates = image_dates[image_dates['image_name'].notnull()]
 
-    # Merge
+    # Merge on a single key packed from the object vector segment and image
+    # codes. Images whose segment or name never appear in the object vectors
+    # cannot be matched and are dropped first.
+    segment_ids = object_vectors['segment_id'].cat.categories
+    img_ids = object_vectors['img_id'].cat.categories
+    segment_codes = pd.Categorical(
+        image_dates['segment_id'], categories=segment_ids).codes
+    image_codes = pd.Categorical(
+        image_dates['image_name'], categories=img_ids).codes
+    matched = (segment_codes >= 0) & (image_codes >= 0)
+    image_dates = image_dates[matched].drop(columns='segment_id')
+    image_dates['key'] = pack_codes(
+        [segment_codes[matched], image_codes[matched]],
+        [len(segment_ids), len(img_ids)])
+
+    object_vectors = object_vectors.assign(key=pack_codes(
+        [object_vectors['segment_id'].cat.codes, object_vectors['img_id'].cat.codes],
+        [len(segment_ids), len(img_ids)]))
     object_vectors = object_vectors.merge(
-        image_dates, how='left', left_on=['segment_id', 'img_id'],
-        right_on=['segment_id', 'image_name'], validate='many_to_one')
+        image_dates, how='left', on='key', validate='many_to_one')
+    object_vectors.drop(columns='key', inplace=True)
 
     return object_vectors
@@ -1,21 +1,90 @@
-from subprocess import check_call
+from collections import defaultdict, deque
+import os
+import re
+from subprocess import check_call, Popen, STDOUT
 import sys
+import time
 
 
 PYTHON = sys.executable
 
+# Number of commands allowed to train at the same time. Commands that share a
+# --device are always run one after the other.
+MAX_PARALLEL_RUNS = int(os.environ.get('MAX_PARALLEL_RUNS', 1))
+POLL_SECONDS = 10
+
 COMMANDS = [
     'python train.py --batch 4 --cfg models/yolov5s.yaml --weights yolov5s.pt --img 640 --hyp data/hyps/hyp.modified.yaml --epochs 100 --data data.yaml --name freeze_lr0001 --project urbanchange --device 0 --entity urbanchange',
     'python train.py --batch 4 --cfg models/yolov5s.yaml --weights yolov5s.pt --img 640 --hyp data/hyps/hyp.modified2.yaml --epochs 100 --data data.yaml --name freeze_lr0005 --project urbanchange --device 0 --entity urbanchange']
 
 
+def get_device(cmd):
+    """
+    Returns the --device argument of a training command
+    :param cmd: (str) training command
+    :return: (str) device or None if the command does not specify one
+    """
+    device = re.search(r'--device\s+(\S+)', cmd)
+    return device.group(1) if device else None
+
+
+def run_parallel(commands, max_parallel_runs):
+    """
+    Runs the training commands with at most one command per device and
+    max_parallel_runs commands at a time. The output of command i is written
+    to run{i}.log.
+    :param commands: (list) training commands
+    :param max_parallel_runs: (int) maximum number of concurrent commands
+    :return: None
+    """
+    # Queue commands by device
+    device_queues = defaultdict(deque)
+    for i, cmd in enumerate(commands):
+        device_queues[get_device(cmd)].append((i, cmd))
+
+    running = {}
+    failed = []
+    while device_queues or running:
+        # Launch the next command on each idle device
+        for device in list(device_queues.keys()):
+            if len(running) >= max_parallel_runs:
+                break
+            if device in running:
+                continue
+            i, cmd = device_queues[device].popleft()
+            if not device_queues[device]:
+                del device_queues[device]
+
+            print('[INFO] Running command #{} on device {}'.format(i, device))
+            print(cmd)
+            log_file = open('run{}.log'.format(i), 'w')
+            running[device] = (
+                i, Popen(cmd, shell=True, stdout=log_file, stderr=STDOUT),
+                log_file)
+
+        # Collect finished commands
+        time.sleep(POLL_SECONDS)
+        for device, (i, process, log_file) in list(running.items()):
+            if process.poll() is not None:
+                log_file.close()
+                del running[device]
+                if process.returncode != 0:
+                    failed.append(i)
+
+    if failed:
+        raise Exception('[ERROR] Failed commands: {}'.format(sorted(failed)))
+
+
 if __name__ == '__main__':
-    # Loop over each command
-    for i, cmd in enumerate(COMMANDS):
-        print('[INFO] Running command #{}'.format(i))
+    if MAX_PARALLEL_RUNS > 1:
+        run_parallel(COMMANDS, MAX_PARALLEL_RUNS)
+    else:
+        # Loop over each command
+        for i, cmd in enumerate(COMMANDS):
+            print('[INFO] Running command #{}'.format(i))
 
-        # Execute
-        print(cmd)
-        check_call(cmd, shell=True)
+            # Execute
+            print(cmd)
+            check_call(cmd, shell=True)
 
 print('[INFO] Complete.')
@@ -1,4 +1,6 @@
+from concurrent.futures import ThreadPoolExecutor
 from datetime import date
+import hashlib
 from io import BytesIO
 import json
 import math
@@ -6,8 +8,13 @@ import numpy as np
 import os
 import osmnx as ox
 import pandas as pd
+import pickle
 from PIL import Image
 import requests
+import threading
+import time
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 
 # Geocoding street segments --------------------------------
@@ -31,6 +38,27 @@ def compute_heading(bearing):
         raise Exception('[ERROR] Bearing should be between 0 and 360.')
 
 
+def compute_headings(bearings):
+    """
+    Computes the headings returned by compute_heading for an array of
+    bearings at once.
+    :param bearings: (np.array or pd.Series) street segment orientations
+    :return: (tuple) of two np.arrays of headings, which are NaN where the
+    bearing is missing
+    """
+    bearings = np.asarray(bearings, dtype=float)
+    if (bearings > 360).any():
+        raise Exception('[ERROR] Bearing should be between 0 and 360.')
+
+    first_quadrant = (bearings >= 0) & (bearings <= 90)
+    heading1 = np.where(
+        first_quadrant | (bearings <= 270), bearings + 90, bearings - 90)
+    heading2 = np.where(
+        first_quadrant, bearings + 270,
+        np.where(bearings <= 270, bearings - 90, bearings - 270))
+    return heading1, heading2
+
+
 def generate_new_latlng_from_distance(cur_lat,
                                       cur_lng,
                                       segment_bearing,
@@ -49,14 +77,17 @@ def generate_new_latlng_from_distance(cur_lat,
     cur_lat, cur_lng = math.radians(cur_lat), math.radians(cur_lng)
     bearing_rad = math.radians(segment_bearing)
 
+    # Compute each trigonometric term once
+    sin_lat, cos_lat = math.sin(cur_lat), math.cos(cur_lat)
+    sin_dist, cos_dist = math.sin(distance / radius), math.cos(distance / radius)
+
     # Compute new coordinates
-    new_lat = math.sin(cur_lat) * math.cos(distance / radius) + \
-              math.cos(cur_lat) * math.sin(distance / radius) * math.cos(bearing_rad)
+    new_lat = sin_lat * cos_dist + cos_lat * sin_dist * math.cos(bearing_rad)
     new_lat = math.asin(new_lat)
 
     new_lng = math.atan2(
-        math.sin(bearing_rad) * math.sin(distance / radius) * math.cos(cur_lat),
-        math.cos(distance / radius) - math.sin(cur_lat) * math.sin(new_lat))
+        math.sin(bearing_rad) * sin_dist * cos_lat,
+        cos_dist - sin_lat * math.sin(new_lat))
     new_lng = cur_lng + new_lng
 
     # Convert back to degrees and append to coordinate list
@@ -66,6 +97,20 @@ def generate_new_latlng_from_distance(cur_lat,
 
 
 # Google APIs ----------------------------------
+# Shared session for all Google API requests: keeps connections to the API
+# alive across requests and retries rate-limited or failed requests
+REQUEST_TIMEOUT = 10  # Seconds
+_SESSION = requests.Session()
+_SESSION.mount('https://', HTTPAdapter(
+    pool_connections=16, pool_maxsize=64,
+    max_retries=Retry(total=3, backoff_factor=0.3,
+                      status_forcelist=[429, 500, 502, 503, 504],
+                      raise_on_status=False)))
+
+# Leading bytes of every PNG file
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+
 def save_SV_image(params, output_dir, file_name):
     """
     Saves the Google Street View image for a particular location as specified
@@ -77,12 +122,27 @@ def save_SV_image(params, output_dir, file_name):
     """
     # Request and get image
     img_base_url = 'https://maps.googleapis.com/maps/api/streetview?'
-    img_request = requests.get(img_base_url, params)
-    img = Image.open(BytesIO(img_request.content))
+    img_request = _SESSION.get(img_base_url, params=params, timeout=REQUEST_TIMEOUT)
 
     # Save image
     output_file = os.path.join(output_dir, '{}.png'.format(file_name))
-    img.save(output_file)
+    write_SV_image(img_request.content, output_file)
+
+
+def write_SV_image(content, output_file):
+    """
+    Writes the content of a Google Street View image response to a PNG file.
+    PNG responses are written as they are; other formats (the API returns
+    JPEG by default) are decoded and re-encoded as PNG.
+    :param content: (bytes) image response content
+    :param output_file: (str)
+    :return: Null (saves image to file)
+    """
+    if content.startswith(PNG_SIGNATURE):
+        with open(output_file, 'wb') as file:
+            file.write(content)
+    else:
+        Image.open(BytesIO(content)).save(output_file)
 
 
 def get_SV_image(params):
@@ -94,11 +154,48 @@ def get_SV_image(params):
     """
     # Request and get image
     img_base_url = 'https://maps.googleapis.com/maps/api/streetview?'
-    img_request = requests.get(img_base_url, params)
+    img_request = _SESSION.get(img_base_url, params=params, timeout=REQUEST_TIMEOUT)
     img = Image.open(BytesIO(img_request.content))
     return img
 
 
+def save_SV_images(params_list, output_files, max_workers=8, max_qps=None):
+    """
+    Saves the Google Street View images for several locations concurrently.
+    The requests are I/O bound, so threads overlap their network round trips.
+    Raises on the first failed download, so returning means every image was
+    saved.
+    :param params_list: (list of dict) request parameters for each image
+    :param output_files: (list of str) output path for each image
+    :param max_workers: (int) maximum number of concurrent requests
+    :param max_qps: (float) maximum number of requests started per second, or
+    None for no limit
+    :return: Null (saves images to file)
+    """
+    lock = threading.Lock()
+    next_request = [time.monotonic()]
+
+    def throttle():
+        # Reserve the next request slot and wait for it
+        with lock:
+            slot = max(next_request[0], time.monotonic())
+            next_request[0] = slot + 1 / max_qps
+        time.sleep(max(0, slot - time.monotonic()))
+
+    def save_image(params, output_file):
+        if max_qps is not None:
+            throttle()
+        img_request = _SESSION.get(
+            'https://maps.googleapis.com/maps/api/streetview?', params=params,
+            timeout=REQUEST_TIMEOUT)
+        img_request.raise_for_status()
+        write_SV_image(img_request.content, output_file)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        # Consume the results to raise any exception from the workers
+        list(executor.map(save_image, params_list, output_files))
+
+
 def get_SV_metadata(params):
     """
     Returns the Google Street View metadata for an image at a particular
@@ -108,21 +205,94 @@ def get_SV_metadata(params):
     :return: (dict)
     """
     meta_base_url = 'https://maps.googleapis.com/maps/api/streetview/metadata?parameters'
-    meta_request = requests.get(meta_base_url, params)
+    meta_request = _SESSION.get(
+        meta_base_url, params=params, timeout=REQUEST_TIMEOUT)
     content = json.loads(meta_request.content)
     return content
 
 
-def reverse_geocode(params):
+def get_SV_metadata_batch(params_list, max_workers=32):
+    """
+    Returns the Google Street View metadata for several locations, requesting
+    them concurrently.
+    :param params_list: (list of dict) request parameters for each location
+    :param max_workers: (int) maximum number of concurrent requests
+    :return: (list of dict) metadata in the same order as params_list
+    """
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(get_SV_metadata, params_list))
+
+
+def reverse_geocode(params, cache_file=None):
     """
     Generate a list of addresses for a given (lat, lon) coordinate pair.
     :param params: (dict) a dictionary including the API key and latlng
     coordinates for which to generate the addresses
+    :param cache_file: (str) optional pickle file in which successful
+    responses are kept across runs, keyed by the request parameters other than
+    the API key, so repeated requests are not sent again. New responses are
+    only written to the file by save_geocode_cache.
     :return: (dict) a dictionary including the information generated by
     the request to the Geocode API for the location.
     """
+    if cache_file is not None:
+        cache = _load_geocode_cache(cache_file)
+        cache_key = tuple(sorted(
+            (name, str(value)) for name, value in params.items()
+            if name != 'key'))
+        if cache_key in cache:
+            return cache[cache_key]
+
     geo_base_url = 'https://maps.googleapis.com/maps/api/geocode/json?'
-    return requests.get(geo_base_url, params).json()
+    response = _SESSION.get(
+        geo_base_url, params=params, timeout=REQUEST_TIMEOUT).json()
+
+    # Only cache definitive answers, not quota or server errors
+    if cache_file is not None and response['status'] in ['OK', 'ZERO_RESULTS']:
+        cache[cache_key] = response
+        _UNSAVED_GEOCODE_CACHES.add(cache_file)
+
+    return response
+
+
+def save_geocode_cache(cache_file):
+    """
+    Writes the reverse geocoding responses cached in this process to
+    cache_file if any were added since it was last saved. The cache is written
+    to a temporary file and moved into place, so an interrupted write never
+    leaves a partial cache behind.
+    :param cache_file: (str)
+    :return: void
+    """
+    if cache_file not in _UNSAVED_GEOCODE_CACHES:
+        return
+
+    temp_file = '{}.{}.tmp'.format(cache_file, os.getpid())
+    try:
+        with open(temp_file, 'wb') as file:
+            pickle.dump(_GEOCODE_CACHES[cache_file], file,
+                        protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_file, cache_file)
+    finally:
+        if os.path.exists(temp_file):
+            os.remove(temp_file)
+    _UNSAVED_GEOCODE_CACHES.discard(cache_file)
+
+
+# Reverse geocoding caches loaded in this process, by cache file, and the
+# cache files with responses not yet saved
+_GEOCODE_CACHES = {}
+_UNSAVED_GEOCODE_CACHES = set()
+
+
+def _load_geocode_cache(cache_file):
+    if cache_file not in _GEOCODE_CACHES:
+        if os.path.exists(cache_file):
+            with open(cache_file, 'rb') as file:
+                _GEOCODE_CACHES[cache_file] = pickle.load(file)
+        else:
+            _GEOCODE_CACHES[cache_file] = {}
+    return _GEOCODE_CACHES[cache_file]
 
 
 def geocode(params):
@@ -133,7 +303,7 @@ def geocode(params):
     request to the Geocode API for the address.
     """
     geo_base_url = 'https://maps.googleapis.com/maps/api/geocode/json?'
-    return requests.get(geo_base_url, params)
+    return _SESSION.get(geo_base_url, params=params, timeout=REQUEST_TIMEOUT)
 
 
 # Street network graphs ----------------------------------
@@ -159,14 +329,47 @@ def generate_location_graph(neighborhood, simplify):
         raise Exception('[ERROR] Location type must be one of [box, place]')
 
 
+# Street network graphs cached by load_location_graph, shared by all scripts
+GRAPH_CACHE_DIR = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    'Outputs', 'Cache')
+
+
+def load_location_graph(neighborhood, simplify):
+    """
+    Loads a location's street network from a GraphML file in GRAPH_CACHE_DIR,
+    generating and saving it first if the file does not exist. This avoids
+    downloading and simplifying the street network every time a script is
+    run. The file is named after a hash of the neighborhood definition and
+    the simplify flag, so editing a location generates a new graph.
+    :param neighborhood: (dict)
+    :param simplify: (bool) whether the street network should be simplified
+    :return: (networkx.MultiDiGraph)
+    """
+    neighborhood_hash = hashlib.sha1(
+        json.dumps(neighborhood, sort_keys=True).encode()).hexdigest()
+    graph_file = os.path.join(GRAPH_CACHE_DIR, 'graph_{}_{}.graphml'.format(
+        neighborhood_hash, simplify))
+    if os.path.exists(graph_file):
+        return ox.load_graphml(graph_file)
+
+    graph = generate_location_graph(neighborhood=neighborhood, simplify=simplify)
+    os.makedirs(GRAPH_CACHE_DIR, exist_ok=True)
+    ox.save_graphml(graph, filepath=graph_file)
+    return graph
+
+
 # Urban index plotting
-def generate_urbanindex_gdf(edges, indices):
+def generate_urbanindex_gdf(edges, indices, index_cols=('index',)):
     """
     Generates a GeoDataFrame for an urban index.
     :param edges: pd.DataFrame resulting from calling ox.graph_to_gdfs on the
     location's graph.
     :param indices: pd.DataFrame generated from reading in an urban index CSV;
     contains an 'index' column which is the specific index to plot.
+    :param index_cols: (list of str) index columns to keep; segments are
+    dropped if all of them are missing. Passing several columns allows
+    merging the segment geometries once for multiple indices.
     :return: (GeoDataFrame)
     """
     # Process edges
@@ -175,46 +378,81 @@ def generate_urbanindex_gdf(edges, indices):
     edges = edges.drop_duplicates(subset=['u', 'v'])
 
     # Get nodes and index column from indices
-    indices['node0'] = indices['segment_id'].str.split('-', expand=True)[0]
-    indices['node1'] = indices['segment_id'].str.split('-', expand=True)[1]
+    indices[['node0', 'node1']] = indices['segment_id'].str.split(
+        '-', n=1, expand=True)
 
-    indices = indices[['node0', 'node1', 'index']]
+    indices = indices[['node0', 'node1'] + list(index_cols)]
     indices = indices.astype({"node0": np.int64, "node1": np.int64})
 
     # Merge segment data and graph data
-    # Note: We need to merge twice, otherwise we get missing geometry values.
-    # This is because in 01_generate_street_segments we ordered the node values
-    # numerically, and some edges are only 1 directional.
-    indices0 = pd.merge(indices, edges, how='left', left_on=['node0', 'node1'],
-                        right_on=['u', 'v'], validate='many_to_one')
-    indices1 = pd.merge(indices, edges, how='left', left_on=['node0', 'node1'],
-                        right_on=['v', 'u'], validate='many_to_one')
-    indices0.dropna(subset=['geometry'], inplace=True)
-    indices1.dropna(subset=['geometry'], inplace=True)
-
-    # Get complete data by concatenating both DataFrames and dropping duplicates
-    indices_full = pd.concat([indices0, indices1])
-    indices_full.drop_duplicates(subset=['node0', 'node1'], inplace=True)
-    complete = pd.merge(indices, indices_full[['node0', 'node1', 'geometry', 'length']],
-                        how='left', validate='one_to_one')
+    # Note: In 01_generate_street_segments we ordered the node values
+    # numerically, and some edges are only 1 directional, so we match segments
+    # and edges on their numerically ordered node pair. When an edge exists in
+    # both directions, we keep the one going from the lower to the higher node.
+    # The node pair is packed into a single int64 key to merge on; node ids
+    # are first mapped to dense codes since OSM ids do not fit in 32 bits.
+    node_codes, node_ids = pd.factorize(np.concatenate([
+        edges['u'].to_numpy(np.int64), edges['v'].to_numpy(np.int64),
+        indices['node0'].to_numpy(), indices['node1'].to_numpy()]), sort=True)
+    n_nodes = np.int64(len(node_ids))
+    u, v, node0, node1 = np.split(node_codes.astype(np.int64), np.cumsum(
+        [len(edges), len(edges), len(indices)]))
+
+    edges['key'] = np.minimum(u, v) * n_nodes + np.maximum(u, v)
+    edges['reverse'] = u > v
+    edges = edges.sort_values('reverse', kind='mergesort').drop_duplicates(
+        subset='key')
+
+    indices['key'] = np.minimum(node0, node1) * n_nodes + np.maximum(node0, node1)
+    complete = pd.merge(
+        indices, edges[['key', 'geometry', 'length']], how='left',
+        on='key', validate='many_to_one')
+    complete.drop(columns='key', inplace=True)
 
     # Drop missing index values
-    complete.dropna(subset=['index'], inplace=True)
+    complete.dropna(subset=list(index_cols), how='all', inplace=True)
 
     return complete
 
 
+def step_colors(values, colors, index):
+    """
+    Maps an array of values to colors in the same way a branca StepColormap
+    built from the colors and index would, without calling the colormap once
+    per value.
+    :param values: (np.array or pd.Series) values to color
+    :param colors: (list of str) hex colors, one for each step
+    :param index: (list of float) bounds of the steps (one more than colors)
+    :return: (np.array) of hex colors
+    """
+    # A value falls in step i if it is above index[i] and at most
+    # index[i + 1]; values beyond the bounds take the first or last color
+    steps = np.searchsorted(np.asarray(index), np.asarray(values), side='left') - 1
+    steps = steps.clip(0, len(colors) - 1)
+    return np.asarray(colors)[steps]
+
+
 # Logger -------------------------------------------------
-class Logger:
-    def __init__(self, path):
+class AppendLogger:
+    # Loggers append to existing files, which is what resuming relies on
+    _mode = 'ab'
+
+    def __init__(self, path, flush_every=100):
         """
-        Instantiates the logger as a .txt file at the specified path
+        Instantiates the logger as a .txt file at the specified path. The file
+        is only created on the first flush. Lines are buffered and written
+        every flush_every lines with a single write, so an interrupted process
+        leaves whole lines behind. A partial last line left by an older
+        interrupted run is dropped so the file can be resumed.
         :param path: (str) path to model outputs
+        :param flush_every: (int) number of lines between flushes to disk
         """
         self.path = path
-
-        with open(self.path, 'w') as file:
-            file.write('')
+        self.flush_every = flush_every
+        self._file = None
+        self._lines = []
+        if self._mode == 'ab' and os.path.exists(path):
+            drop_partial_line(path)
 
     def write(self, text):
         """
@@ -222,30 +460,94 @@ class Logger:
         :param text: (str)
         :return: void
         """
-        with open(self.path, 'a+') as file:
-            file.write(text + '\n')
-
+        self._lines.append(text + '\n')
+        if len(self._lines) >= self.flush_every:
+            self.flush()
 
-class AppendLogger:
-    def __init__(self, path):
+    def flush(self):
         """
-        Instantiates the logger as a .txt file at the specified path
-        :param path: (str) path to model outputs
+        Writes the buffered lines to the logger file.
+        :return: void
         """
-        self.path = path
-
-    def write(self, text):
+        if not self._lines:
+            return
+        if self._file is None:
+            self._file = open(self.path, self._mode, buffering=0)
+            # Reopening after close() must not truncate what was written
+            self._mode = 'ab'
+
+        data = memoryview(''.join(self._lines).encode())
+        while data:
+            data = data[self._file.write(data):]
+        self._lines = []
+
+    def close(self):
         """
-        Writes text to logger.
-        :param text: (str)
+        Flushes and closes the logger file. Must be called before reading the
+        file back in the same process, and on errors so buffered lines are not
+        lost: use the logger as a context manager or close it in a finally.
         :return: void
         """
-        with open(self.path, 'a+') as file:
-            file.write(text + '\n')
+        self.flush()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class Logger(AppendLogger):
+    """
+    Logger that overwrites any existing file at the specified path on its
+    first flush. Later flushes, also after close(), append to that file.
+    """
+    _mode = 'wb'
+
+
+def drop_partial_line(path, block_size=65536):
+    """
+    Truncates a text file after its last newline, removing a line that was
+    only partially written when a process was killed.
+    :param path: (str)
+    :param block_size: (int) number of bytes read at a time from the end
+    :return: void
+    """
+    with open(path, 'r+b') as file:
+        end = file.seek(0, os.SEEK_END)
+        while end > 0:
+            start = max(0, end - block_size)
+            file.seek(start)
+            block = file.read(end - start)
+            last_newline = block.rfind(b'\n')
+            if last_newline >= 0:
+                if start + last_newline + 1 < file.seek(0, os.SEEK_END):
+                    file.truncate(start + last_newline + 1)
+                return
+            end = start
+        file.truncate(0)
+
+
+# Output files -------------------------------------------
+def output_is_current(output_files, input_files):
+    """
+    Checks whether all output files were generated after the last modification
+    of every input file they are generated from, in which case they do not
+    need to be regenerated. Scripts should list themselves as an input so
+    changes to their parameters regenerate the outputs.
+    :param output_files: (list of str)
+    :param input_files: (list of str)
+    :return: (bool)
+    """
+    if not all(os.path.exists(output_file) for output_file in output_files):
+        return False
+    return min(os.path.getmtime(output_file) for output_file in output_files) > \
+        max(os.path.getmtime(input_file) for input_file in input_files)
 
 
 # Processing images -------------------------
 def get_image_name(image_path):
-    image_name = image_path.split(os.path.sep)[-1]
-    image_name = '.'.join(image_name.split('.')[:-1])
-    return image_name
+    return os.path.splitext(os.path.basename(image_path))[0]
@@ -1,3 +1,6 @@
+import numpy as np
+import pandas as pd
+
 from DataScripts.object_classes import CLASSES_TO_LABEL
 
 
@@ -13,18 +16,24 @@ MISSING_IMAGE_NORMALIZATION = [
 PANORAMA_COVERAGE = 2  # (average meters covered by each panorama view)
 MIN_NUMBER_OF_PANORAMAS = 8
 
+# Object classes in CLASSES_TO_LABEL order, built once rather than per segment
+CLASS_NAMES = list(CLASSES_TO_LABEL.keys())
+CLASS_DTYPE = pd.CategoricalDtype(CLASS_NAMES)
+
 
-def generate_full_agg_dictionary(agg_series):
+def generate_full_agg_dictionary(class_counts, class_observed):
     """
-    Generates a dictionary including all object classes from a pd.Series
-    :param agg_series: (pd.Series) representing object instance counts or
+    Generates a dictionary including all object classes from an array of
+    class counts ordered as CLASSES_TO_LABEL
+    :param class_counts: (np.array) representing object instance counts or
     weighted counts for each type of class
+    :param class_observed: (np.array) of bools indicating which classes were
+    observed; classes that were not observed are set to 0
     :return: (dict)
     """
-    agg_dict = {}
-    for obj_class in CLASSES_TO_LABEL.keys():
-        agg_dict[obj_class] = agg_series.get(key=obj_class, default=0)
-    return agg_dict
+    agg_values = [count if observed else 0 for count, observed in
+                  zip(class_counts.tolist(), class_observed)]
+    return dict(zip(CLASS_NAMES, agg_values))
 
 
 # Normalization functions
@@ -60,65 +69,125 @@ def adjust_length_with_missings(length, num_missing_images,
     return adj_length
 
 
+# Object weights for each aggregation type: the amount each object instance
+# adds to its class count
+def count_weights(df, img_size):
+    return df['img_id'].notnull().to_numpy(dtype=float)
+
+
+def conf_weights(df, img_size):
+    return df['confidence'].to_numpy(dtype=float)
+
+
+def bbox_weights(df, img_size):
+    return df['bbox_size'].to_numpy(dtype=float) / (img_size * img_size) * 100
+
+
+def confxbbox_weights(df, img_size):
+    return df['bbox_size'].to_numpy(dtype=float) / (img_size * img_size) * 100 * \
+        df['confidence'].to_numpy(dtype=float)
+
+
+AGGREGATION_WEIGHTS = {
+    'count': count_weights,
+    'Conf_weighted': conf_weights,
+    'Bbox_weighted': bbox_weights,
+    'ConfxBbox_weighted': confxbbox_weights
+}
+
+
 # Aggregation functions
+def aggregate_all(df, img_size, length, num_missing_images, num_captured_images,
+                  missing_img_normalization, agg_types=None):
+    """
+    Aggregates a DataFrame representing the object instances observed in a
+    particular street segment by generating a weighted count of the number
+    of objects in each class, for several aggregation types at once. The class
+    of each object and the normalization are only computed once.
+    :param df: (pd.DataFrame) containing rows for a particular segment_id,
+    and the columns: img_id, confidence, bbox_size and class. Each row
+    represents the instance of an object observed in an image associated
+    to the street segment.
+    :param img_size: (int) image resolution
+    :param length: (float) length of the street segment (meters)
+    :param num_captured_images: (int) number of images captured for the segment
+    :param num_missing_images: (int) number of panoramas that were missing
+    when collecting the imagery for the street segment
+    :param missing_img_normalization: one of the MISSING_IMAGE_NORMALIZATION
+    list
+    :param agg_types: (list of str) aggregation types to compute; defaults to
+    all the types in AGGREGATION_WEIGHTS
+    :return: (dict) of weighted counts for each class, for each aggregation type
+    """
+    if agg_types is None:
+        agg_types = AGGREGATION_WEIGHTS.keys()
+
+    # Normalization (computed once for all aggregation types)
+    if missing_img_normalization in ['length_adjustment', 'mark_missing']:
+        adj_length = adjust_length_with_missings(
+            length, num_missing_images, missing_img_normalization)
+    elif missing_img_normalization != 'pano_adjustment':
+        raise Exception('[ERROR] Incorrect adjustment selection.')
+
+    # Segments without objects have a zero count for every class
+    if len(df) == 0:
+        return {agg_type: dict.fromkeys(CLASS_NAMES, 0) for agg_type in agg_types}
+
+    # Get the position of each object's class in CLASSES_TO_LABEL (-1 for
+    # classes that are not labeled). Callers can set the class column's
+    # categories to CLASS_NAMES once beforehand so its codes are used as they
+    # are. Note: categorical dtypes compare equal regardless of category order,
+    # so the categories themselves are compared.
+    if isinstance(df['class'].dtype, pd.CategoricalDtype) and \
+            df['class'].cat.categories.equals(CLASS_DTYPE.categories):
+        class_codes = df['class'].cat.codes.to_numpy()
+    else:
+        class_codes = pd.Categorical(df['class'], dtype=CLASS_DTYPE).codes
+    labeled = class_codes >= 0
+    labeled_codes = class_codes[labeled]
+    observed = np.bincount(labeled_codes, minlength=len(CLASS_NAMES)) > 0
+
+    aggregations = {}
+    for agg_type in agg_types:
+        # Sum the weight each object adds to its class count (missing weights
+        # are skipped)
+        weights = AGGREGATION_WEIGHTS[agg_type](df, img_size)
+        counts = np.bincount(
+            labeled_codes, weights=np.nan_to_num(weights[labeled]),
+            minlength=len(CLASS_NAMES))
+
+        # Normalize
+        if missing_img_normalization == 'pano_adjustment':
+            counts = counts / num_captured_images
+        else:
+            counts = counts / adj_length * LENGTH_RATE
+
+        # Generate complete dictionary
+        aggregations[agg_type] = generate_full_agg_dictionary(counts, observed)
+
+    return aggregations
+
+
 def generate_agg_function(agg_type):
+    if agg_type not in AGGREGATION_WEIGHTS:
+        raise Exception('[ERROR] Incorrect aggregation type.')
+
     def agg_function(df, img_size, length, num_missing_images,
                      num_captured_images, missing_img_normalization):
         """
         Aggregates a DataFrame representing the object instances observed in a
         particular street segment by generating a weighted count of the number
-        of objects in each class.
-        :param df: (pd.DataFrame) containing rows for a particular segment_id,
-        and the columns: img_id, confidence, bbox_size and class. Each row
-        represents the instance of an object observed in an image associated
-        to the street segment.
-        :param img_size: (int) image resolution
-        :param length: (float) length of the street segment (meters)
-        :param num_captured_images: (int) number of images captured for the segment
-        :param num_missing_images: (int) number of panoramas that were missing
-        when collecting the imagery for the street segment
-        :param missing_img_normalization: one of the MISSING_IMAGE_NORMALIZATION
-        list
+        of objects in each class. See aggregate_all for the parameters.
         :return: (dict) of weighted counts for each class
         """
-        if agg_type == 'count':
-            counts = df[['img_id', 'class']].groupby(['class']).count()
-            counts.rename(columns={'img_id': 'index'}, inplace=True)
-        elif agg_type == 'Conf_weighted':
-            counts = df[['confidence', 'class']].groupby(['class']).sum()
-            counts.rename(columns={'confidence': 'index'}, inplace=True)
-        elif agg_type == 'Bbox_weighted':
-            df['normalized_bbox'] = df['bbox_size'] / (img_size * img_size) * 100
-            counts = df[['normalized_bbox', 'class']].groupby(['class']).sum()
-            counts.rename(columns={'normalized_bbox': 'index'}, inplace=True)
-        elif agg_type == 'ConfxBbox_weighted':
-            df['normalized_bbox'] = df['bbox_size'] / (img_size * img_size) * 100
-            df['conf_normalized_bbox'] = df['normalized_bbox'] * df['confidence']
-            counts = df[['conf_normalized_bbox', 'class']].groupby(['class']).sum()
-            counts.rename(columns={'conf_normalized_bbox': 'index'}, inplace=True)
-        else:
-            raise Exception('[ERROR] Incorrect aggregation type.')
-
-        # Normalize
-        if missing_img_normalization in ['length_adjustment', 'mark_missing']:
-            adj_length = adjust_length_with_missings(
-                length, num_missing_images, missing_img_normalization)
-            counts = counts / adj_length * LENGTH_RATE
-        elif missing_img_normalization == 'pano_adjustment':
-            counts = counts / num_captured_images
-        else:
-            raise Exception('[ERROR] Incorrect adjustment selection.')
-
-        # Generate complete dictionary
-        counts = generate_full_agg_dictionary(counts['index'])
-        return counts
+        return aggregate_all(
+            df, img_size, length, num_missing_images, num_captured_images,
+            missing_img_normalization, agg_types=[agg_type])[agg_type]
 
     return agg_function
 
 
 # Define aggregation types
-aggregation_types = ['count', 'Conf_weighted', 'Bbox_weighted', 'ConfxBbox_weighted']
-
 AGGREGATIONS = {}
-for agg in aggregation_types:
+for agg in AGGREGATION_WEIGHTS.keys():
     AGGREGATIONS[agg] = generate_agg_function(agg)